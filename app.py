@@ -1,34 +1,123 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, g, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, g, session, make_response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+import click
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_mail import Mail, Message
 from flask_babel import Babel, gettext as _, lazy_gettext as _l
 from flask_wtf import CSRFProtect, FlaskForm
 import psycopg2
-from wtforms import StringField, PasswordField, FloatField, DateField, TextAreaField, FileField, BooleanField, EmailField, SubmitField, DecimalField 
-from wtforms.validators import DataRequired, Email, Length, NumberRange
+from psycopg2 import extensions as pg_ext, pool as pg_pool
+from wtforms import StringField, PasswordField, FloatField, DateField, TextAreaField, FileField, BooleanField, EmailField, SubmitField
+from wtforms.validators import DataRequired, Email, Length, NumberRange, Optional
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+import bisect
 import csv
+import hashlib
 import io
+import json
+import math
+import multiprocessing
 import os
-from collections import defaultdict
-from datetime import datetime, timezone, date
+import re
+import select
+import smtplib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import zlib
+from dataclasses import dataclass, fields, is_dataclass
+from datetime import datetime, timezone, date, timedelta
+from functools import lru_cache
+from decimal import Decimal
+
+import assets
+
+# orjson é opcional: se não estiver instalado, a serialização cai para o json da stdlib
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# brotli também é opcional: sem ele, a compressão usa apenas gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Redis é opcional: com LOGIN_RATE_REDIS_URL, o limite de login é compartilhado entre processos/máquinas
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# NumPy é opcional: sem ele, os KPIs são calculados em Python puro
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# ----------------- SERIALIZAÇÃO JSON RÁPIDA -----------------
+def _json_default(obj):
+    """
+    Converte os tipos que o JSON não conhece nativamente:
+      - datetime/date -> string ISO 8601 (mesmo formato do orjson; datetime sem fuso = UTC,
+                         como o formato HTTP usado antes pelo Flask)
+      - Decimal       -> float
+      - arrays colunares (NumPy, array.array) -> lista
+      - dataclasses (ex.: Recharge) -> dict campo a campo (o orjson já faz isso nativamente)
+    """
+    if isinstance(obj, datetime):
+        return (obj if obj.tzinfo else obj.replace(tzinfo=timezone.utc)).isoformat()
+    if isinstance(obj, date):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if is_dataclass(obj):
+        return {f.name: getattr(obj, f.name) for f in fields(obj)}
+    raise TypeError(f"Objeto do tipo {type(obj).__name__} não é serializável em JSON")
 
-# --- Helper para normalizar datas vindas do Postgres/strings ---
-def _to_month(value):
-    try:
-        from datetime import datetime, date
-        if isinstance(value, (datetime, date)):
-            return value.strftime("%Y-%m")
-        return datetime.fromisoformat(str(value)).strftime("%Y-%m")
-    except Exception:
-        return str(value)[:7]
 
+_ORJSON_OPTIONS = (orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC) if orjson else 0
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Provider JSON do Flask que usa orjson quando disponível (com fallback para a stdlib).
+    Usado por jsonify() e request.get_json() em todas as rotas.
+    """
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None:
+            return orjson.dumps(obj, default=_json_default, option=_ORJSON_OPTIONS).decode()
+        kwargs.setdefault("default", _json_default)
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        # Com kwargs (ex.: object_hook do serializador da sessão) só a stdlib atende
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if orjson is None or self._app.debug:
+            return super().response(*args, **kwargs)
+        # Gera bytes direto, sem passar por str
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=_json_default, option=_ORJSON_OPTIONS)
+        return self._app.response_class(body, mimetype=self.mimetype)
 
 
 # ----------------- CONFIGURAÇÕES INICIAIS DO FLASK -----------------
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "default_key")
+app.json = FastJSONProvider(app)
 
 # Adicione este bloco no app.py:
 @app.context_processor
@@ -38,11 +127,14 @@ def inject_int_functions():
 
 
 # ----------------- Configuração do Gmail SMTP -----------------
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
+# Servidor/porta/TLS podem ser trocados por variáveis de ambiente (ex.: SMTP local para testes)
+app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', 'smtp.gmail.com')
+app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', 587))
+app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS', '1') == '1'
 app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')  # seu email
 app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')  # app password
+# Quem recebe as mensagens do formulário de contato (padrão: a própria conta de envio)
+app.config['MAIL_CONTACT_TO'] = os.getenv('MAIL_CONTACT_TO') or app.config['MAIL_USERNAME']
 mail = Mail(app)
 
 
@@ -78,6 +170,111 @@ def get_locale():
 babel = Babel(app, locale_selector=get_locale)
 
 
+# ----------------- COMPRESSÃO DAS RESPOSTAS (gzip / brotli) -----------------
+# Respostas menores que COMPRESS_MIN_SIZE bytes não compensam o custo de CPU
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_GZIP_LEVEL'] = int(os.getenv('COMPRESS_GZIP_LEVEL', 6))
+app.config['COMPRESS_BROTLI_QUALITY'] = int(os.getenv('COMPRESS_BROTLI_QUALITY', 4))
+app.config['COMPRESS_MIMETYPES'] = {
+    'text/html', 'text/css', 'text/csv', 'text/plain', 'text/javascript',
+    'application/javascript', 'application/json', 'image/svg+xml',
+}
+
+
+class _GzipStream:
+    """Compressor incremental gzip (mesma interface usada para o brotli)."""
+    def __init__(self, level):
+        # wbits=31 -> cabeçalho/rodapé gzip
+        self._comp = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._comp.compress(data)
+
+    def finish(self):
+        return self._comp.flush()
+
+
+class _BrotliStream:
+    """Compressor incremental brotli."""
+    def __init__(self, quality):
+        self._comp = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._comp.process(data)
+
+    def finish(self):
+        return self._comp.finish()
+
+
+def _novo_compressor(encoding):
+    if encoding == 'br':
+        return _BrotliStream(app.config['COMPRESS_BROTLI_QUALITY'])
+    return _GzipStream(app.config['COMPRESS_GZIP_LEVEL'])
+
+
+def _comprimir_stream(chunks, encoding, charset):
+    """Comprime um corpo em streaming (gerador), sem carregar tudo em memória."""
+    comp = _novo_compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            data = comp.compress(chunk)
+            if data:
+                yield data
+        yield comp.finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+@app.after_request
+def compress_response(response):
+    """Negocia Accept-Encoding e comprime HTML, JSON, CSV, JS e CSS."""
+    if (request.method == 'HEAD'
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers
+            or 'Range' in request.headers
+            or response.mimetype not in app.config['COMPRESS_MIMETYPES']):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if not encoding:
+        return response
+
+    if response.is_streamed or response.direct_passthrough:
+        # Arquivo estático traz Content-Length: respeita o mesmo limite mínimo.
+        # Só o stream de tamanho desconhecido é comprimido sem essa checagem.
+        tamanho = response.content_length
+        if tamanho is not None and tamanho < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        # Comprime em blocos, sem carregar o corpo inteiro na memória
+        response.response = _comprimir_stream(response.response, encoding, response.charset)
+        response.direct_passthrough = False
+        response.headers.pop('Content-Length', None)
+        response.headers.pop('Accept-Ranges', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        comp = _novo_compressor(encoding)
+        response.set_data(comp.compress(data) + comp.finish())
+
+    response.headers['Content-Encoding'] = encoding
+    # ETag passa a ser fraco: a representação comprimida não é byte a byte igual
+    etag, _weak = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# ----------------- ASSETS ESTÁTICOS E TEXTOS DO JAVASCRIPT -----------------
+# Compartilhados com o app_sqlite3.py (mesmos templates): ver assets.py
+assets.init_app(app)
+
+
 # ----------------- Proteção CSRF -----------------
 csrf = CSRFProtect(app)
 
@@ -86,6 +283,319 @@ login_manager = LoginManager(app)
 login_manager.login_view = "index"
 
 
+# ----------------- CONEXÃO COM O BANCO (pool) -----------------
+# Cada request usa no máximo uma conexão de cada pool (primário e réplica), então DB_POOL_MAX deve ser
+# pelo menos o número de threads por worker (gunicorn --threads; o worker sync padrão usa 1).
+# Com o pool cheio, getconn espera até DB_POOL_ESPERA segundos por uma devolução antes de falhar.
+app.config['DB_POOL_MIN'] = int(os.getenv('DB_POOL_MIN', 1))
+app.config['DB_POOL_MAX'] = int(os.getenv('DB_POOL_MAX', 5))
+app.config['DB_POOL_ESPERA'] = float(os.getenv('DB_POOL_ESPERA', 10))  # segundos
+
+
+class ConexaoComPreparados(pg_ext.connection):
+    """Conexão que lembra quais comandos já receberam PREPARE nesta sessão do servidor."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparados = set()
+
+
+class PooledConnectionPool(pg_pool.ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool que espera por uma conexão livre em vez de lançar PoolError
+    na hora: um pico de requests enfileira por alguns instantes em vez de virar erro 500.
+    """
+    def __init__(self, minconn, maxconn, *args, espera=0, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self._vagas = threading.BoundedSemaphore(maxconn)
+        self._espera = espera
+
+    def getconn(self, key=None):
+        if not self._vagas.acquire(timeout=self._espera):
+            raise pg_pool.PoolError(f"nenhuma conexão livre no pool após {self._espera:g}s")
+        try:
+            return super().getconn(key)
+        except BaseException:
+            self._vagas.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        # Vaga liberada só se a devolução deu certo: conexão alheia ou pool fechado lançam PoolError
+        # sem terem ocupado vaga (liberar aqui sobraria vaga e o BoundedSemaphore lançaria ValueError)
+        super().putconn(conn, key, close)
+        self._vagas.release()
+
+
+_db_pool = None
+_db_pool_replica = None
+_db_pool_lock = threading.Lock()
+
+
+def _novo_pool(url):
+    return PooledConnectionPool(app.config['DB_POOL_MIN'], app.config['DB_POOL_MAX'], url,
+                                espera=app.config['DB_POOL_ESPERA'], connection_factory=ConexaoComPreparados)
+
+
+def _get_pool():
+    # Criado sob demanda: cada worker do gunicorn abre o seu depois do fork
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = _novo_pool(os.getenv('DATABASE_URL'))
+    return _db_pool
+
+
+def _get_pool_replica():
+    global _db_pool_replica
+    if _db_pool_replica is None:
+        with _db_pool_lock:
+            if _db_pool_replica is None:
+                _db_pool_replica = _novo_pool(app.config['DATABASE_REPLICA_URL'])
+    return _db_pool_replica
+
+
+def get_db():
+    """Retorna a conexão do request atual (emprestada do pool e devolvida no teardown)."""
+    if 'db' not in g:
+        g.db = _get_pool().getconn()
+    return g.db
+
+
+# ----------------- RÉPLICA DE LEITURA -----------------
+# Rotas só de leitura (dashboard, séries, listagem, exportação) usam get_db_leitura(): com
+# DATABASE_REPLICA_URL definida, vão para a réplica. Logo depois de uma escrita do próprio usuário
+# (marcada na sessão, que vale para todos os workers), ficam no primário por DB_REPLICA_JANELA
+# segundos, para ele ver o que acabou de gravar mesmo com a réplica atrasada.
+app.config['DATABASE_REPLICA_URL'] = os.getenv('DATABASE_REPLICA_URL')
+app.config['DB_REPLICA_JANELA'] = float(os.getenv('DB_REPLICA_JANELA', 10))  # segundos
+
+_METODOS_ESCRITA = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+
+@app.after_request
+def marcar_escrita(response):
+    if (request.method in _METODOS_ESCRITA and response.status_code < 400
+            and app.config['DATABASE_REPLICA_URL'] and current_user.is_authenticated):
+        session['_ultima_escrita'] = time.time()
+    return response
+
+
+def get_db_leitura():
+    """Conexão para leituras: a réplica, salvo na janela após uma escrita do usuário ou se ela cair."""
+    if 'db_leitura' not in g:
+        g.db_leitura = None
+        recente = time.time() - session.get('_ultima_escrita', 0) < app.config['DB_REPLICA_JANELA']
+        if app.config['DATABASE_REPLICA_URL'] and not recente:
+            try:
+                g.db_leitura = _get_pool_replica().getconn()
+            except psycopg2.Error:
+                app.logger.exception('Réplica indisponível; lendo do primário')
+        incrementar_metrica('db_leituras_replica_total' if g.db_leitura is not None
+                            else 'db_leituras_primario_total')
+    return g.db_leitura if g.db_leitura is not None else get_db()
+
+
+def _devolver(pool, conn):
+    # Descarta qualquer transação aberta (ex.: só SELECTs) antes de devolver ao pool;
+    # putconn uma única vez, pois cada devolução libera uma vaga do pool
+    try:
+        conn.rollback()
+    except psycopg2.Error:
+        pool.putconn(conn, close=True)
+    else:
+        pool.putconn(conn)
+
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        _devolver(_get_pool(), conn)
+    conn = g.pop('db_leitura', None)
+    if conn is not None:
+        _devolver(_get_pool_replica(), conn)
+
+
+# ----------------- COMANDOS PREPARADOS (PREPARE uma vez por conexão) -----------------
+# As consultas quentes rodam com EXECUTE: o Postgres analisa o SQL uma vez por conexão do pool
+# e, depois de algumas execuções, reaproveita o plano genérico. O nome do comando vem do texto do SQL,
+# então as variações da listagem (uma por forma de filtro/ordenação) ganham cada uma o seu.
+# DB_PREPARE=0 desliga (ex.: atrás de um pgbouncer em modo transaction, que não guarda PREPARE).
+app.config['DB_PREPARE'] = os.getenv('DB_PREPARE', '1') == '1'
+
+_comandos_preparados = {}  # sql -> (nome no servidor, sql com $1..$n, quantidade de parâmetros)
+
+
+def _comando_preparado(familia, sql):
+    comando = _comandos_preparados.get(sql)
+    if comando is None:
+        contador = iter(range(1, sql.count('%s') + 1))
+        sql_numerado = re.sub(r'%s', lambda _m: f'${next(contador)}', sql)
+        nome = f'{familia}_{hashlib.sha1(sql.encode()).hexdigest()[:10]}'
+        comando = _comandos_preparados.setdefault(sql, (nome, sql_numerado, sql.count('%s')))
+    return comando
+
+
+def executar_preparado(cursor, familia, sql, params=()):
+    """
+    cursor.execute(sql, params) via PREPARE/EXECUTE na conexão do pool. 'familia' nomeia o comando
+    e as métricas sql_<familia>_* (execuções, segundos, prepares e segundos de prepare).
+    """
+    conn = cursor.connection
+    inicio = time.perf_counter()
+    if not app.config['DB_PREPARE'] or not isinstance(conn, ConexaoComPreparados):
+        cursor.execute(sql, params)
+    else:
+        nome, sql_numerado, qtd = _comando_preparado(familia, sql)
+        if nome not in conn.preparados:
+            cursor.execute(f'PREPARE {nome} AS {sql_numerado}')
+            conn.preparados.add(nome)
+            incrementar_metrica(f'sql_{familia}_prepare_total')
+            incrementar_metrica(f'sql_{familia}_prepare_segundos_total', time.perf_counter() - inicio)
+            inicio = time.perf_counter()
+        if qtd:
+            cursor.execute(f'EXECUTE {nome} ({", ".join(["%s"] * qtd)})', params)
+        else:
+            cursor.execute(f'EXECUTE {nome}')
+    incrementar_metrica(f'sql_{familia}_execucoes_total')
+    incrementar_metrica(f'sql_{familia}_segundos_total', time.perf_counter() - inicio)
+
+
+# ----------------- CACHES POR USUÁRIO -----------------
+# Cache em memória do processo com expiração. Semeado no login, para que a primeira
+# página depois dele (dashboard/conta) não precise ir ao banco por identidade e configurações.
+app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 300))  # segundos
+
+
+class CacheTTL:
+    """Dicionário com expiração por item e tamanho máximo (descarta o mais antigo)."""
+
+    def __init__(self, max_itens=10000):
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_itens = max_itens
+
+    def get(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None:
+                return None
+            valor, expira = item
+            if expira < time.monotonic():
+                del self._itens[chave]
+                return None
+            return valor
+
+    def set(self, chave, valor, ttl=None):
+        with self._lock:
+            self._itens.pop(chave, None)
+            self._itens[chave] = (valor, time.monotonic() + (ttl or app.config['USER_CACHE_TTL']))
+            if len(self._itens) > self._max_itens:
+                self._itens.popitem(last=False)
+
+    def pop(self, chave):
+        with self._lock:
+            self._itens.pop(chave, None)
+
+    def clear(self):
+        with self._lock:
+            self._itens.clear()
+
+
+# user_id -> User / user_id -> (preco_gasolina, consumo_km_l) ou None (sem configuração)
+cache_usuarios = CacheTTL()
+cache_settings = CacheTTL()
+_SEM_SETTINGS = ()  # marcador de "não tem linha em settings" (None significa "não está no cache")
+
+
+# ----------------- SERVIÇO DE CONFIGURAÇÕES (settings) -----------------
+# Leitura: g (uma vez por request) -> cache_settings (processo) -> banco.
+# Escrita: um único upsert; em seguida todos os processos descartam o cache daquele usuário
+# (NOTIFY settings, ouvido por uma thread em cada worker) e avisam os caches que dependem dele.
+app.config['SETTINGS_LISTEN'] = os.getenv('SETTINGS_LISTEN', '1') == '1'
+
+_ouvintes_settings = []
+_thread_settings = None
+_thread_settings_lock = threading.Lock()
+
+
+def ao_alterar_settings(funcao):
+    """Registra funcao(user_id), chamada em cada processo quando as configurações do usuário mudam."""
+    _ouvintes_settings.append(funcao)
+    return funcao
+
+
+def _invalidar_settings(user_id):
+    cache_settings.pop(user_id)
+    for funcao in _ouvintes_settings:
+        funcao(user_id)
+
+
+def _escutar_settings():
+    """Thread do worker: aplica as invalidações feitas pelos outros processos."""
+    while True:
+        try:
+            conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+            conn.autocommit = True
+            conn.cursor().execute('LISTEN settings')
+            # Enquanto não escutava, alguma gravação pode ter passado despercebida
+            cache_settings.clear()
+            while True:
+                if select.select([conn], [], [], 60) != ([], [], []):
+                    conn.poll()
+                    while conn.notifies:
+                        _invalidar_settings(int(conn.notifies.pop(0).payload))
+        except Exception:
+            app.logger.exception('Ouvinte de settings caiu; reconectando')
+            cache_settings.clear()
+            time.sleep(5)
+
+
+def _iniciar_ouvinte_settings():
+    # Sob demanda (como o pool): cada worker do gunicorn inicia a sua depois do fork
+    global _thread_settings
+    if _thread_settings is None and app.config['SETTINGS_LISTEN']:
+        with _thread_settings_lock:
+            if _thread_settings is None:
+                _thread_settings = threading.Thread(target=_escutar_settings, name='settings-listen', daemon=True)
+                _thread_settings.start()
+
+
+def obter_settings(user_id):
+    """(preco_gasolina, consumo_km_l) do usuário, ou None se ele ainda não configurou."""
+    por_request = g.setdefault('_settings', {})
+    if user_id in por_request:
+        return por_request[user_id]
+    _iniciar_ouvinte_settings()
+    config = cache_settings.get(user_id)
+    if config is None:
+        cursor = get_db().cursor()
+        executar_preparado(cursor, 'settings', "SELECT preco_gasolina, consumo_km_l FROM settings WHERE user_id=%s",
+                           (user_id,))
+        config = cursor.fetchone() or _SEM_SETTINGS
+        cache_settings.set(user_id, config)
+    por_request[user_id] = config if config is not _SEM_SETTINGS else None
+    return por_request[user_id]
+
+
+def salvar_settings(user_id, preco_gasolina, consumo_km_l):
+    """Grava com um único upsert (sem corrida entre SELECT e INSERT) e invalida os caches."""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO settings (user_id, preco_gasolina, consumo_km_l) VALUES (%s, %s, %s)
+        ON CONFLICT (user_id) DO UPDATE
+            SET preco_gasolina = EXCLUDED.preco_gasolina, consumo_km_l = EXCLUDED.consumo_km_l
+        RETURNING preco_gasolina, consumo_km_l
+    """, (user_id, preco_gasolina, consumo_km_l))
+    config = cursor.fetchone()
+    cursor.execute("SELECT pg_notify('settings', %s)", (str(user_id),))
+    conn.commit()
+    _invalidar_settings(user_id)
+    cache_settings.set(user_id, config)
+    g.setdefault('_settings', {})[user_id] = config
+
+
 # ----------------- MODELO DE USUÁRIO -----------------
 class User(UserMixin):
     def __init__(self, id, nome, email):
@@ -95,15 +605,200 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    user = cache_usuarios.get(int(user_id))
+    if user is not None:
+        return user
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute("SELECT id, nome, email FROM users WHERE id=%s", (user_id,))
+    executar_preparado(cursor, 'usuario', "SELECT id, nome, email FROM users WHERE id=%s", (int(user_id),))
     row = cursor.fetchone()
-    conn.close()
     if row:
-        return User(row[0], row[1], row[2])
+        user = User(row[0], row[1], row[2])
+        cache_usuarios.set(row[0], user)
+        return user
+    return None
+
+# ----------------- HASH DE SENHAS (política configurável) -----------------
+# Método no formato do Werkzeug: 'scrypt:N:r:p' ou 'pbkdf2:sha256:iterações' (padrão: scrypt do Werkzeug).
+# Hashes gravados com outra política são regravados no próximo login bem-sucedido.
+app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD', 'scrypt')
+# > 0: verificação/geração em um pool de processos desse tamanho (não trava a GIL do worker web)
+app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('PASSWORD_HASH_WORKERS', 0))
+
+_senha_pool = None
+_senha_pool_lock = threading.Lock()
+_metodos_normalizados = {}
+
+
+def _metodo_senha():
+    """Método configurado já com os parâmetros explícitos (ex.: 'scrypt' -> 'scrypt:32768:8:1')."""
+    metodo = app.config['PASSWORD_HASH_METHOD']
+    if metodo not in _metodos_normalizados:
+        _metodos_normalizados[metodo] = generate_password_hash('', method=metodo).split('$', 1)[0]
+    return _metodos_normalizados[metodo]
+
+
+def _executar_hash(funcao, *args):
+    global _senha_pool
+    workers = app.config['PASSWORD_HASH_WORKERS']
+    if workers <= 0:
+        return funcao(*args)
+    if _senha_pool is None:
+        with _senha_pool_lock:
+            if _senha_pool is None:
+                # Criado sob demanda (depois do fork do gunicorn); 'spawn' evita herdar threads/conexões
+                _senha_pool = ProcessPoolExecutor(max_workers=workers,
+                                                  mp_context=multiprocessing.get_context('spawn'))
+    return _senha_pool.submit(funcao, *args).result()
+
+
+def gerar_hash_senha(senha):
+    return _executar_hash(generate_password_hash, senha, _metodo_senha())
+
+
+def verificar_senha(senha_hash, senha):
+    return _executar_hash(check_password_hash, senha_hash, senha)
+
+
+def precisa_rehash(senha_hash):
+    """True se o hash foi gerado com um método/custo diferente da política atual."""
+    return senha_hash.split('$', 1)[0] != _metodo_senha()
+
+
+# ----------------- MÉTRICAS -----------------
+# Contadores em memória do processo, expostos em /metrics (formato texto do Prometheus).
+# A rota só existe de fato com METRICS_TOKEN definido (Authorization: Bearer <token>).
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+
+_metricas = {}
+_metricas_lock = threading.Lock()
+
+
+def incrementar_metrica(nome, valor=1):
+    with _metricas_lock:
+        _metricas[nome] = _metricas.get(nome, 0) + valor
+
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        return Response(status=404)
+    if request.headers.get('Authorization') != f'Bearer {token}':
+        return Response(status=401)
+    with _metricas_lock:
+        linhas = [f'evchargelog_{nome} {valor}' for nome, valor in sorted(_metricas.items())]
+    return Response('\n'.join(linhas) + '\n', mimetype='text/plain')
+
+
+# ----------------- LIMITE DE TENTATIVAS DE LOGIN (token bucket) -----------------
+# Cada IP e cada e-mail têm um balde: cada tentativa consome 1 ficha e as fichas voltam aos poucos.
+# Sem ficha, o login é recusado antes de consultar o banco ou calcular o hash da senha.
+app.config['LOGIN_RATE_IP_CAPACIDADE'] = int(os.getenv('LOGIN_RATE_IP_CAPACIDADE', 20))
+app.config['LOGIN_RATE_IP_POR_MINUTO'] = float(os.getenv('LOGIN_RATE_IP_POR_MINUTO', 10))
+app.config['LOGIN_RATE_EMAIL_CAPACIDADE'] = int(os.getenv('LOGIN_RATE_EMAIL_CAPACIDADE', 5))
+app.config['LOGIN_RATE_EMAIL_POR_MINUTO'] = float(os.getenv('LOGIN_RATE_EMAIL_POR_MINUTO', 2))
+app.config['LOGIN_RATE_REDIS_URL'] = os.getenv('LOGIN_RATE_REDIS_URL')
+# Quantidade de proxies confiáveis na frente da aplicação (ex.: 1 no Heroku) para achar o IP real
+app.config['TRUSTED_PROXIES'] = int(os.getenv('TRUSTED_PROXIES', 0))
+
+
+class TokenBucketLimiter:
+    """Token bucket em memória do processo (LRU limitado a max_chaves)."""
+
+    def __init__(self, max_chaves=10000):
+        self._baldes = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_chaves = max_chaves
+
+    def consumir(self, chave, capacidade, por_segundo):
+        """Retorna (permitido, segundos até a próxima ficha)."""
+        agora = time.monotonic()
+        with self._lock:
+            fichas, ultimo = self._baldes.pop(chave, (capacidade, agora))
+            fichas = min(capacidade, fichas + (agora - ultimo) * por_segundo)
+            permitido = fichas >= 1
+            if permitido:
+                fichas -= 1
+            self._baldes[chave] = (fichas, agora)
+            if len(self._baldes) > self._max_chaves:
+                self._baldes.popitem(last=False)
+        return permitido, 0.0 if permitido else (1 - fichas) / por_segundo
+
+    def zerar(self, chave):
+        with self._lock:
+            self._baldes.pop(chave, None)
+
+
+class RedisTokenBucketLimiter:
+    """Mesmo algoritmo em um script Lua (atômico), compartilhado por todos os workers."""
+    _SCRIPT = """
+        local capacidade, por_segundo, agora = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local estado = redis.call('HMGET', KEYS[1], 'fichas', 'ultimo')
+        local fichas = tonumber(estado[1]) or capacidade
+        local ultimo = tonumber(estado[2]) or agora
+        fichas = math.min(capacidade, fichas + math.max(0, agora - ultimo) * por_segundo)
+        local permitido = 0
+        if fichas >= 1 then
+            fichas = fichas - 1
+            permitido = 1
+        end
+        redis.call('HSET', KEYS[1], 'fichas', fichas, 'ultimo', agora)
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacidade / por_segundo) + 1)
+        return {permitido, tostring(fichas)}
+    """
+
+    def __init__(self, url):
+        self._redis = redis.Redis.from_url(url)
+        self._consumir = self._redis.register_script(self._SCRIPT)
+
+    def consumir(self, chave, capacidade, por_segundo):
+        permitido, fichas = self._consumir(keys=[f'login_rate:{chave}'],
+                                           args=[capacidade, por_segundo, time.time()])
+        return bool(permitido), 0.0 if permitido else (1 - float(fichas)) / por_segundo
+
+    def zerar(self, chave):
+        self._redis.delete(f'login_rate:{chave}')
+
+
+_login_limiter = None
+
+
+def login_limiter():
+    global _login_limiter
+    if _login_limiter is None:
+        url = app.config['LOGIN_RATE_REDIS_URL']
+        _login_limiter = RedisTokenBucketLimiter(url) if (url and redis) else TokenBucketLimiter()
+    return _login_limiter
+
+
+def _ip_cliente():
+    proxies = app.config['TRUSTED_PROXIES']
+    if proxies and len(request.access_route) > proxies:
+        return request.access_route[-proxies - 1]
+    return request.remote_addr
+
+
+def verificar_limite_login(email):
+    """
+    Consome uma ficha do IP e outra do e-mail. Retorna None se liberado,
+    ou os segundos de espera sugeridos (Retry-After) se bloqueado.
+    """
+    limiter = login_limiter()
+    incrementar_metrica('login_tentativas_total')
+    regras = (
+        ('ip', _ip_cliente(), app.config['LOGIN_RATE_IP_CAPACIDADE'], app.config['LOGIN_RATE_IP_POR_MINUTO']),
+        ('email', (email or '').strip().lower(),
+         app.config['LOGIN_RATE_EMAIL_CAPACIDADE'], app.config['LOGIN_RATE_EMAIL_POR_MINUTO']),
+    )
+    for tipo, valor, capacidade, por_minuto in regras:
+        permitido, espera = limiter.consumir(f'{tipo}:{valor}', capacidade, por_minuto / 60)
+        if not permitido:
+            incrementar_metrica(f'login_bloqueados_{tipo}_total')
+            return max(1, int(espera + 0.999))
     return None
 
+
 # ----------------- FORMULÁRIOS -----------------
 class LoginForm(FlaskForm):
     # Rótulos marcados para tradução
@@ -121,10 +816,10 @@ class RegisterForm(FlaskForm):
 class RechargeForm(FlaskForm):
     # Rótulos marcados para tradução
     data = DateField(_l("Data"), validators=[DataRequired()])
-    kwh = DecimalField(_l("kWh"), places=2, rounding=None, validators=[DataRequired(), NumberRange(min=0.01)])
-    custo = DecimalField(_l("Custo"), places=2, rounding=None, validators=[DataRequired(), NumberRange(min=0.0)])
+    kwh = FloatField(_l("kWh"), validators=[DataRequired(), NumberRange(min=0.01)])
+    custo = FloatField(_l("Custo"), validators=[DataRequired(), NumberRange(min=0.0)])
     isento = BooleanField(_l("Isento"))
-    odometro = DecimalField(_l("Odômetro"), validators=[DataRequired(), NumberRange(min=0.1)])
+    odometro = FloatField(_l("Odômetro"), validators=[DataRequired(), NumberRange(min=0.1)])
     local = StringField(_l("Local"))
     observacoes = TextAreaField(_l("Observações"))
     submit = SubmitField(_l("Salvar Recarga")) # Adicionei um botão de submit
@@ -133,6 +828,7 @@ class AccountForm(FlaskForm):
     # Rótulos marcados para tradução
     preco_gasolina = FloatField(_l("Preço da Gasolina"), validators=[DataRequired(), NumberRange(min=0.0)])
     consumo_km_l = FloatField(_l("Consumo Médio (km/l)"), validators=[DataRequired(), NumberRange(min=0.1)])
+    regiao = StringField(_l("Região"), validators=[Optional(), Length(max=50)])
     submit = SubmitField(_l("Atualizar Configurações")) # Adicionei um botão de submit
 
 class BulkRechargeForm(FlaskForm):
@@ -149,29 +845,56 @@ class ContactForm(FlaskForm):
 
 
 # ----------------- FUNÇÃO AUXILIAR PARA DIRECIONAR AS CONFIRGURAÇÕES -----------------
+def config_completa(preco_gasolina, consumo_km_l) -> bool:
+    # Regra: ambos não nulos e consumo > 0
+    return (preco_gasolina is not None) and (consumo_km_l is not None) and (float(consumo_km_l) > 0)
+
+
 def has_complete_config(user_id: int) -> bool:
     """
     Retorna True se o usuário possui preco_gasolina e consumo_km_l preenchidos,
     considerando consumo_km_l > 0. Caso contrário, retorna False.
     """
-    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT preco_gasolina, consumo_km_l
-        FROM settings
-        WHERE user_id=%s
-    """, (user_id,))
-    row = cursor.fetchone()
-    conn.close()
-
-    if not row:
-        return False
-    preco_gasolina, consumo_km_l = row
-    # Regra: ambos não nulos e consumo > 0
-    return (preco_gasolina is not None) and (consumo_km_l is not None) and (float(consumo_km_l) > 0)
+    config = obter_settings(user_id)
+    return config is not None and config_completa(*config)
 
 
 # ----------------- FUNÇÃO AUXILIAR FORMATAR NÚMEROS (AUTO por idioma) -----------------
+# Formato numérico por idioma: (separador decimal, separador de milhar, prefixo monetário)
+_FORMATOS_NUMERO = {
+    'pt_BR': (',', '.', 'R$ '),
+}
+_FORMATO_NUMERO_PADRAO = ('.', ',', '$ ')
+
+
+def _idioma_atual():
+    """Resolve o idioma como antes: sessão -> selector do Babel -> cabeçalho do navegador."""
+    try:
+        lang = session.get('lang')
+        if not lang:
+            try:
+                lang = str(get_locale())
+            except Exception:
+                lang = None
+        if not lang and request is not None:
+            lang = request.accept_languages.best_match(app.config.get('LANGUAGES', []))
+        return lang
+    except Exception:
+        return None
+
+
+def _formato_numero():
+    """Formato do idioma atual, resolvido uma única vez por request e guardado em g."""
+    try:
+        fmt = g.get('_formato_numero')
+        if fmt is None:
+            fmt = g._formato_numero = _FORMATOS_NUMERO.get(_idioma_atual(), _FORMATO_NUMERO_PADRAO)
+        return fmt
+    except RuntimeError:
+        # Fora de contexto de aplicação (ex.: scripts): padrão americano
+        return _FORMATO_NUMERO_PADRAO
+
+
 def brl(value, digitos=2, com_prefixo=True):
     """
     Formata números conforme o idioma atual:
@@ -188,35 +911,14 @@ def brl(value, digitos=2, com_prefixo=True):
         # fallback visual quando não há valor numérico
         return "-"
 
-    # Tenta obter o locale atual do Babel; cai para sessão/browser se necessário
-    try:
-        # get_locale foi definido no seu app e passado ao Babel como locale_selector
-        lang = None
-        # 1) sessão (se você troca via %slang=)
-        lang = session.get('lang')
-        # 2) Babel (selector)
-        if not lang:
-            # Se get_locale existe, usa
-            try:
-                lang = str(get_locale())
-            except Exception:
-                lang = None
-        # 3) cabeçalho do navegador (fallback)
-        if not lang and request is not None:
-            lang = request.accept_languages.best_match(app.config.get('LANGUAGES', []))
-    except Exception:
-        lang = None
+    decimal, milhar, prefixo = _formato_numero()
 
-    # Formata em string com separadores padrão US
-    s_us = f"{v:,.{digitos}f}"  # ex.: 1234.56 -> "1,234.56"
-
-    if lang == 'pt_BR':
-        # Converte para padrão brasileiro: milhar '.' e decimal ','
-        s_br = s_us.replace(",", "X").replace(".", ",").replace("X", ".")
-        return f"R$ {s_br}" if com_prefixo else s_br
-    else:
-        # Mantém padrão americano
-        return f"$ {s_us}" if com_prefixo else s_us
+    # Agrupa com '_' (não colide com o ponto decimal) e aplica os símbolos do idioma
+    s = f"{v:_.{digitos}f}"  # ex.: 1234.56 -> "1_234.56"
+    if decimal != '.':
+        s = s.replace('.', decimal)
+    s = s.replace('_', milhar)
+    return prefixo + s if com_prefixo else s
 
 # Atualiza/registrar filtro único 'brl' no Jinja (substitui os anteriores)
 app.jinja_env.filters["brl"] = brl
@@ -341,6 +1043,688 @@ def validate_csv_and_parse(file_storage):
 
 
 
+# ----------------- REGISTRO DE RECARGA -----------------
+# Colunas na mesma ordem dos campos de Recharge: Recharge(*row) monta o registro direto do cursor
+SQL_CAMPOS_RECARGA = "id, data, kwh, custo, isento, odometro, local, observacoes"
+
+
+@dataclass
+class Recharge:
+    """
+    Uma linha da tabela recharges. Com __slots__ não há __dict__ por instância,
+    e o orjson serializa dataclasses direto, sem montar um dict intermediário.
+    """
+    __slots__ = ('id', 'data', 'kwh', 'custo', 'isento', 'odometro', 'local', 'observacoes')
+    id: int
+    data: datetime
+    kwh: float
+    custo: float
+    isento: bool
+    odometro: float
+    local: str
+    observacoes: str
+
+    def linha_csv(self):
+        """Valores na ordem das colunas do CSV de exportação."""
+        return (self.data, self.kwh, self.custo, self.isento, self.odometro,
+                self.local or '', self.observacoes or '')
+
+
+# ----------------- COMPILADOR DE FILTROS DE RECARGAS -----------------
+# Listagem, exportação CSV e ações em lote usam os mesmos filtros. Os parâmetros são validados e
+# convertidos uma vez (FiltroRecargas); o SQL depende só de quais filtros vieram (a "forma") e é
+# montado uma vez por forma, com texto estável (bom para planos preparados no servidor).
+class FiltroInvalido(ValueError):
+    """Parâmetro de filtro com valor inválido; o nome do parâmetro fica em .campo."""
+
+    def __init__(self, campo):
+        super().__init__(campo)
+        self.campo = campo
+
+
+def _texto_filtro(params, nome, max_len):
+    # None/ausente = sem filtro; no JSON, 0 ou false não podem virar "sem filtro" em silêncio
+    valor = params.get(nome)
+    if valor is None:
+        return ''
+    if not isinstance(valor, str) or len(valor) > max_len:
+        raise FiltroInvalido(nome)
+    return valor.strip().lower()
+
+
+def _data_filtro(params, nome):
+    valor = params.get(nome)
+    if valor is None or valor == '':
+        return None
+    try:
+        return date.fromisoformat(valor)
+    except (TypeError, ValueError):
+        raise FiltroInvalido(nome) from None
+
+
+@dataclass(frozen=True)
+class FiltroRecargas:
+    local: str = ''
+    observacoes: str = ''
+    isento: bool = None  # None = todas
+    date_from: date = None
+    date_to: date = None
+
+    @classmethod
+    def de_parametros(cls, params):
+        """Valida request.args (ou o dict 'filters' do JSON) e converte para os tipos do banco."""
+        isento = params.get('isento')
+        if isinstance(isento, bool):
+            # Booleano do JSON (false não pode cair em "todas")
+            isento = 'true' if isento else 'false'
+        elif isento is None or isento == '':
+            isento = 'all'
+        if isento not in ('all', 'true', 'false'):
+            raise FiltroInvalido('isento')
+        return cls(local=_texto_filtro(params, 'local', 255),
+                   observacoes=_texto_filtro(params, 'observacoes', 2000),
+                   isento=None if isento == 'all' else isento == 'true',
+                   date_from=_data_filtro(params, 'date_from'),
+                   date_to=_data_filtro(params, 'date_to'))
+
+    @property
+    def forma(self):
+        """Nomes dos filtros presentes, na ordem dos campos (chave do cache de SQL)."""
+        return tuple(f.name for f in fields(self) if getattr(self, f.name) not in ('', None))
+
+    @property
+    def aplicado(self):
+        return bool(self.forma)
+
+
+# Datas comparam a própria coluna (faixa no índice user_id, data); date_to vira "antes do dia seguinte"
+_CONDICOES_FILTRO = {
+    'local': 'LOWER(local) LIKE %s',
+    'observacoes': 'LOWER(observacoes) LIKE %s',
+    'isento': 'isento = %s',
+    'date_from': 'data >= %s',
+    'date_to': 'data < %s',
+}
+
+
+def _contem(texto):
+    # Curingas digitados pelo usuário valem como texto (escape padrão do LIKE é a barra invertida)
+    return '%' + texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+@lru_cache(maxsize=None)  # no máximo 2^5 formas
+def where_da_forma(forma):
+    return ' AND '.join(['user_id = %s'] + [_CONDICOES_FILTRO[campo] for campo in forma])
+
+
+def compilar_filtro(user_id, filtro):
+    """(where_sql, params) do filtro; o where_sql vem do cache da forma."""
+    params = [user_id]
+    for campo in filtro.forma:
+        valor = getattr(filtro, campo)
+        if campo in ('local', 'observacoes'):
+            valor = _contem(valor)
+        elif campo == 'date_to':
+            valor = valor + timedelta(days=1)
+        params.append(valor)
+    return where_da_forma(filtro.forma), params
+
+
+@lru_cache(maxsize=None)
+def sql_total_recargas(forma):
+    return f'SELECT COUNT(*) FROM recharges WHERE {where_da_forma(forma)}'
+
+
+@lru_cache(maxsize=256)
+def sql_pagina_recargas(forma, sort_by, sort_dir):
+    return f'''
+        SELECT {SQL_CAMPOS_RECARGA}
+        FROM recharges WHERE {where_da_forma(forma)}
+        ORDER BY {sort_by} {sort_dir}
+        LIMIT %s OFFSET %s
+    '''
+
+
+@lru_cache(maxsize=256)
+def sql_pagina_com_total(forma, sort_by, sort_dir):
+    # Página e total numa única leitura: a janela conta as linhas filtradas antes do LIMIT
+    return f'''
+        SELECT {SQL_CAMPOS_RECARGA}, COUNT(*) OVER()
+        FROM recharges WHERE {where_da_forma(forma)}
+        ORDER BY {sort_by} {sort_dir}
+        LIMIT %s OFFSET %s
+    '''
+
+
+@lru_cache(maxsize=None)
+def sql_exportar_recargas(forma):
+    return f'''
+        SELECT {SQL_CAMPOS_RECARGA}
+        FROM recharges
+        WHERE {where_da_forma(forma)}
+        ORDER BY CAST(data AS date), id
+    '''
+
+
+# ----------------- KM ENTRE RECARGAS (km_delta / prev_id) -----------------
+# Cada recarga guarda os km rodados desde a recarga anterior do usuário (mesma ordem do dashboard:
+# dia, id) e o id dela. Toda escrita que mexe em data/odômetro recalcula a partir do dia mais antigo
+# afetado (recargas_alteradas): só as recargas dali em diante são lidas, e só as que mudaram são gravadas.
+SQL_ATUALIZAR_KM_DELTA = """
+    WITH janela AS (
+        SELECT id, CAST(data AS date) AS dia,
+               odometro - LAG(odometro) OVER w AS km_delta, LAG(id) OVER w AS prev_id
+        FROM recharges
+        WHERE user_id = %(user_id)s
+          AND data >= COALESCE((SELECT CAST(MAX(data) AS date) FROM recharges
+                                WHERE user_id = %(user_id)s AND data < %(desde)s), %(desde)s)
+        WINDOW w AS (ORDER BY CAST(data AS date), id)
+    )
+    UPDATE recharges r SET km_delta = j.km_delta, prev_id = j.prev_id
+    FROM janela j
+    WHERE r.id = j.id AND j.dia >= %(desde)s
+      AND (r.km_delta IS DISTINCT FROM j.km_delta OR r.prev_id IS DISTINCT FROM j.prev_id)
+    RETURNING j.dia
+"""
+
+
+def atualizar_km_delta(cursor, user_id, desde):
+    """
+    Recalcula km_delta/prev_id do usuário a partir do dia 'desde', na transação de quem chamou.
+    Retorna os dias das recargas que mudaram.
+    """
+    cursor.execute(SQL_ATUALIZAR_KM_DELTA, {'user_id': user_id, 'desde': desde})
+    return {r[0] for r in cursor.fetchall()}
+
+
+# ----------------- ROLLUPS DE RECARGAS (por dia e por mês) -----------------
+# recharges_rollups guarda os totais de cada dia ('d') e de cada mês ('m') com recargas. Um período
+# qualquer é somado com os meses inteiros dentro dele e os dias avulsos das pontas: no máximo ~60
+# linhas mais uma por mês, sem ler o histórico de recargas.
+SQL_ROLLUPS_DIAS = """
+    INSERT INTO recharges_rollups (user_id, granularidade, inicio, recargas, isentas, km, kwh, custo_total, custo_pagas)
+    SELECT user_id, 'd', CAST(data AS date), COUNT(*), COUNT(*) FILTER (WHERE isento),
+           COALESCE(SUM(km_delta::float8), 0), SUM(kwh::float8), SUM(custo::float8),
+           COALESCE(SUM(custo::float8) FILTER (WHERE NOT isento), 0)
+    FROM recharges
+    WHERE user_id = %s AND data >= %s AND data < %s AND CAST(data AS date) = ANY(%s)
+    GROUP BY user_id, CAST(data AS date)
+"""
+
+SQL_ROLLUPS_MESES = """
+    INSERT INTO recharges_rollups (user_id, granularidade, inicio, recargas, isentas, km, kwh, custo_total, custo_pagas)
+    SELECT user_id, 'm', CAST(date_trunc('month', inicio) AS date), SUM(recargas), SUM(isentas),
+           SUM(km), SUM(kwh), SUM(custo_total), SUM(custo_pagas)
+    FROM recharges_rollups
+    WHERE user_id = %s AND granularidade = 'd' AND inicio >= %s AND inicio < %s
+      AND CAST(date_trunc('month', inicio) AS date) = ANY(%s)
+    GROUP BY user_id, CAST(date_trunc('month', inicio) AS date)
+"""
+
+# Meses inteiros em [mes_de, mes_ate) e dias avulsos em [dia_de, dia_ate) U [dia_de2, dia_ate2)
+SQL_TOTAIS_PERIODO = """
+    SELECT COALESCE(SUM(recargas), 0), COALESCE(SUM(isentas), 0), COALESCE(SUM(km), 0),
+           COALESCE(SUM(kwh), 0), COALESCE(SUM(custo_total), 0), COALESCE(SUM(custo_pagas), 0)
+    FROM recharges_rollups
+    WHERE user_id = %s AND (
+        (granularidade = 'm' AND inicio >= %s AND inicio < %s)
+        OR (granularidade = 'd' AND inicio >= %s AND inicio < %s)
+        OR (granularidade = 'd' AND inicio >= %s AND inicio < %s))
+"""
+
+
+def _dia(valor):
+    return valor.date() if isinstance(valor, datetime) else valor
+
+
+def _inicio_do_mes(dia, meses_a_somar=0):
+    mes = dia.year * 12 + dia.month - 1 + meses_a_somar
+    return date(mes // 12, mes % 12 + 1, 1)
+
+
+def atualizar_rollups(cursor, user_id, dias):
+    """Refaz os rollups dos dias informados e dos meses que os contêm."""
+    dias = sorted(dias)
+    meses = sorted({_inicio_do_mes(d) for d in dias})
+    cursor.execute("""DELETE FROM recharges_rollups WHERE user_id=%s AND granularidade='d' AND inicio = ANY(%s)
+                      RETURNING sketch""", (user_id, dias))
+    antigos = [r[0] for r in cursor.fetchall()]
+    cursor.execute(SQL_ROLLUPS_DIAS, (user_id, dias[0], dias[-1] + timedelta(days=1), dias))
+    atualizar_sketches(cursor, user_id, dias, antigos)
+    cursor.execute("DELETE FROM recharges_rollups WHERE user_id=%s AND granularidade='m' AND inicio = ANY(%s)",
+                   (user_id, meses))
+    cursor.execute(SQL_ROLLUPS_MESES, (user_id, meses[0], _inicio_do_mes(meses[-1], 1), meses))
+
+
+def travar_recargas(cursor, user_id):
+    """
+    Serializa as escritas em recharges de um usuário até o fim da transação. Deve ser o primeiro
+    comando da transação: o recálculo dos derivados mexe em recargas vizinhas, e pegar o lock
+    depois de já ter alterado uma linha deixaria duas escritas concorrentes em deadlock.
+    """
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('recharges_derivados'), %s)", (user_id,))
+
+
+def recargas_alteradas(cursor, user_id, datas, km=True):
+    """
+    Mantém os dados derivados depois de uma escrita em recharges, na mesma transação
+    (que começou com travar_recargas).
+    datas: datas (novas e anteriores) das recargas escritas; km=False quando data e odômetro
+    não mudaram (km_delta não é recalculado).
+    """
+    dias = {_dia(d) for d in datas}
+    if not dias:
+        return
+    if km:
+        dias |= atualizar_km_delta(cursor, user_id, min(dias))
+    atualizar_rollups(cursor, user_id, dias)
+
+
+def totais_periodo(cursor, user_id, inicio, fim):
+    """
+    Totais das recargas com data em [inicio, fim), lidos dos rollups. 'km' é a soma de km_delta:
+    os km rodados desde a última recarga antes do período até a última recarga dentro dele.
+    """
+    mes_de, mes_ate = _inicio_do_mes(inicio, 0 if inicio.day == 1 else 1), _inicio_do_mes(fim)
+    if mes_de < mes_ate:
+        faixas = (mes_de, mes_ate, inicio, mes_de, mes_ate, fim)
+    else:
+        faixas = (mes_de, mes_de, inicio, fim, fim, fim)
+    executar_preparado(cursor, 'totais_periodo', SQL_TOTAIS_PERIODO, (user_id,) + faixas)
+    recargas, isentas, km, kwh, custo_total, custo_pagas = cursor.fetchone()
+    return {"recargas": recargas, "isentas": isentas, "km": km, "kwh": kwh,
+            "custo_total": custo_total, "custo_pagas": custo_pagas}
+
+
+# ----------------- PERCENTIS (sketch por usuário) -----------------
+# Sketch no estilo DDSketch: o valor x > 0 cai no bucket ceil(log_gamma(x)) e qualquer quantil sai
+# com erro relativo de no máximo SKETCH_ALPHA. Como são só contagens, sketches se somam e se subtraem:
+# cada dia dos rollups guarda o seu, e o do usuário (recharges_sketches) recebe só a diferença dos
+# dias reescritos. Editar ou excluir uma recarga tira exatamente a contribuição antiga.
+SKETCH_ALPHA = 0.01
+_SKETCH_LOG_GAMMA = math.log((1 + SKETCH_ALPHA) / (1 - SKETCH_ALPHA))
+
+# Métricas por recarga: preço do kWh das recargas pagas e consumo desde a recarga anterior
+METRICAS_SKETCH = ('custo_kwh', 'consumo_100km')
+
+
+class Sketch:
+    """Histograma de buckets logarítmicos (mais um contador de zeros), serializável em JSON."""
+    __slots__ = ('zeros', 'buckets')
+
+    def __init__(self, zeros=0, buckets=None):
+        self.zeros = zeros
+        self.buckets = buckets or {}
+
+    def __len__(self):
+        return self.zeros + sum(self.buckets.values())
+
+    def adicionar(self, valor):
+        if valor <= 0:
+            self.zeros += 1
+        else:
+            i = math.ceil(math.log(valor) / _SKETCH_LOG_GAMMA)
+            self.buckets[i] = self.buckets.get(i, 0) + 1
+
+    def somar(self, outro, sinal=1):
+        """Soma (ou subtrai, com sinal=-1) as contagens de outro sketch; buckets zerados saem."""
+        self.zeros += sinal * outro.zeros
+        for i, n in outro.buckets.items():
+            total = self.buckets.get(i, 0) + sinal * n
+            if total:
+                self.buckets[i] = total
+            else:
+                self.buckets.pop(i, None)
+
+    def quantil(self, q):
+        """Valor no quantil q (0..1), ou None se o sketch está vazio."""
+        total = len(self)
+        if not total:
+            return None
+        posicao = q * (total - 1)
+        acumulado = self.zeros
+        if posicao < acumulado:
+            return 0.0
+        for i in sorted(self.buckets):
+            acumulado += self.buckets[i]
+            if posicao < acumulado:
+                # Ponto do bucket (gamma^(i-1), gamma^i] com erro relativo <= alpha
+                return 2 * math.exp(i * _SKETCH_LOG_GAMMA) / (1 + math.exp(_SKETCH_LOG_GAMMA))
+        return None
+
+    def para_json(self):
+        return {'z': self.zeros, 'b': {str(i): n for i, n in self.buckets.items()}}
+
+    @classmethod
+    def de_json(cls, dados):
+        return cls(dados.get('z', 0), {int(i): n for i, n in dados.get('b', {}).items()})
+
+
+def sketches_de_json(dados):
+    """{métrica: Sketch} a partir da coluna JSONB (None = sketches vazios)."""
+    dados = dados or {}
+    return {m: Sketch.de_json(dados.get(m, {})) for m in METRICAS_SKETCH}
+
+
+def _json_sketches(sketches):
+    return json.dumps({m: s.para_json() for m, s in sketches.items()}, separators=(',', ':'))
+
+
+def atualizar_sketches(cursor, user_id, dias, antigos):
+    """
+    Grava os sketches dos dias (já reescritos em recharges_rollups) e aplica ao sketch do usuário
+    a diferença entre eles e os sketches antigos desses dias.
+    """
+    por_dia = {d: sketches_de_json(None) for d in dias}
+    cursor.execute("""
+        SELECT CAST(data AS date), kwh, custo, isento, km_delta FROM recharges
+        WHERE user_id = %s AND data >= %s AND data < %s AND CAST(data AS date) = ANY(%s)
+    """, (user_id, dias[0], dias[-1] + timedelta(days=1), dias))
+    for dia, kwh, custo, isento, km_delta in cursor.fetchall():
+        if not isento and kwh > 0:
+            por_dia[dia]['custo_kwh'].adicionar(custo / kwh)
+        if km_delta is not None and km_delta > 0:
+            por_dia[dia]['consumo_100km'].adicionar(kwh / km_delta * 100)
+    cursor.execute("""
+        UPDATE recharges_rollups r SET sketch = v.sketch
+        FROM unnest(%s::date[], %s::jsonb[]) AS v(inicio, sketch)
+        WHERE r.user_id = %s AND r.granularidade = 'd' AND r.inicio = v.inicio
+    """, (dias, [_json_sketches(por_dia[d]) for d in dias], user_id))
+
+    cursor.execute("SELECT sketch FROM recharges_sketches WHERE user_id=%s", (user_id,))
+    row = cursor.fetchone()
+    usuario = sketches_de_json(row[0] if row else None)
+    for sketches, sinal in [(sketches_de_json(a), -1) for a in antigos] + [(d, 1) for d in por_dia.values()]:
+        for m in METRICAS_SKETCH:
+            usuario[m].somar(sketches[m], sinal)
+    cursor.execute("""
+        INSERT INTO recharges_sketches (user_id, sketch) VALUES (%s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET sketch = EXCLUDED.sketch
+    """, (user_id, _json_sketches(usuario)))
+
+
+SQL_SKETCH_USUARIO = "SELECT sketch FROM recharges_sketches WHERE user_id = %s"
+
+
+def percentis_usuario(cursor, user_id):
+    """Mediana e p90 de cada métrica do usuário: {métrica: {'p50': ..., 'p90': ...}} (None sem dados)."""
+    executar_preparado(cursor, 'sketch_usuario', SQL_SKETCH_USUARIO, (user_id,))
+    row = cursor.fetchone()
+    return {m: {'p50': s.quantil(0.5), 'p90': s.quantil(0.9)}
+            for m, s in sketches_de_json(row[0] if row else None).items()}
+
+
+def reconstruir_derivados(cursor, user_id):
+    """Refaz do zero km_delta, rollups e sketches de um usuário (bancos existentes ou dados importados)."""
+    travar_recargas(cursor, user_id)
+    cursor.execute("DELETE FROM recharges_rollups WHERE user_id=%s", (user_id,))
+    cursor.execute("DELETE FROM recharges_sketches WHERE user_id=%s", (user_id,))
+    cursor.execute("SELECT DISTINCT CAST(data AS date) FROM recharges WHERE user_id=%s", (user_id,))
+    recargas_alteradas(cursor, user_id, [r[0] for r in cursor.fetchall()])
+
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Reconstrói km_delta, rollups e sketches de todos os usuários (um commit por usuário)."""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM users ORDER BY id")
+    for (user_id,) in cursor.fetchall():
+        reconstruir_derivados(cursor, user_id)
+        conn.commit()
+        click.echo(f"usuário {user_id}: ok")
+
+
+# ----------------- MOTOR DE KPIs (NumPy opcional) -----------------
+# 'auto' usa NumPy quando instalado; 'python' força o caminho puro (útil para comparar)
+app.config['KPI_ENGINE'] = os.getenv('KPI_ENGINE', 'auto')
+
+# Mesma ordenação do dashboard; o mês vem da coluna gerada recharges.mes (ano * 12 + mês - 1)
+SQL_COLUNAS_RECARGAS = """
+    SELECT mes, kwh, custo, isento, odometro
+    FROM recharges
+    WHERE user_id=%s
+    ORDER BY CAST(data AS date), id
+"""
+
+
+def _usar_numpy():
+    return np is not None and app.config['KPI_ENGINE'] != 'python'
+
+
+def rotulo_mes(mes):
+    """Converte o mês inteiro (ano * 12 + mês - 1) em 'YYYY-MM'."""
+    return f"{mes // 12:04d}-{mes % 12 + 1:02d}"
+
+
+class ColunasRecargas:
+    """
+    Recargas de um usuário em formato colunar, na ordem cronológica.
+    Com NumPy as colunas são arrays contíguos; sem NumPy, tuplas.
+    """
+    __slots__ = ('mes', 'kwh', 'custo', 'isento', 'odometro', 'vetorizado')
+
+    def __init__(self, mes, kwh, custo, isento, odometro, vetorizado):
+        self.mes = mes
+        self.kwh = kwh
+        self.custo = custo
+        self.isento = isento
+        self.odometro = odometro
+        self.vetorizado = vetorizado
+
+    def __len__(self):
+        return len(self.mes)
+
+
+def carregar_colunas(rows):
+    """Transpõe as linhas (mes, kwh, custo, isento, odometro) para colunas."""
+    if _usar_numpy():
+        # Uma única conversão em C para a matriz inteira; None vira NaN e depois 0
+        matriz = np.nan_to_num(np.array(rows, dtype=np.float64).reshape(len(rows), 5))
+        return ColunasRecargas(
+            mes=matriz[:, 0].astype(np.int64),
+            kwh=np.ascontiguousarray(matriz[:, 1]),
+            custo=np.ascontiguousarray(matriz[:, 2]),
+            isento=matriz[:, 3] != 0,
+            odometro=np.ascontiguousarray(matriz[:, 4]),
+            vetorizado=True,
+        )
+    mes, kwh, custo, isento, odometro = zip(*rows) if rows else ((), (), (), (), ())
+    return ColunasRecargas(
+        mes=mes,
+        kwh=tuple(v or 0.0 for v in kwh),
+        custo=tuple(v or 0.0 for v in custo),
+        isento=tuple(bool(v) for v in isento),
+        odometro=tuple(v or 0.0 for v in odometro),
+        vetorizado=False,
+    )
+
+
+def _soma_sequencial(valores):
+    """
+    Soma um array na ordem das linhas, como o laço em Python. O .sum() do NumPy soma por pares e
+    pode mudar o último bit do total, o que às vezes muda o centavo exibido (ex.: 7.200,94 -> 7.200,93).
+    """
+    return float(np.cumsum(valores)[-1]) if len(valores) else 0.0
+
+
+def calcular_totais(cols):
+    """Totais do histórico inteiro (base dos KPIs do dashboard)."""
+    n = len(cols)
+    if cols.vetorizado:
+        isentas = int(cols.isento.sum())
+        custo_total = _soma_sequencial(cols.custo)
+        custo_isentas = _soma_sequencial(cols.custo[cols.isento])
+        custo_pagas = _soma_sequencial(cols.custo[~cols.isento])
+        kwh_total = _soma_sequencial(cols.kwh)
+    else:
+        isentas = sum(cols.isento)
+        custo_total = sum(cols.custo)
+        custo_isentas = sum(c for c, i in zip(cols.custo, cols.isento) if i)
+        custo_pagas = sum(c for c, i in zip(cols.custo, cols.isento) if not i)
+        kwh_total = sum(cols.kwh)
+    return {
+        "recargas": n,
+        "recargas_isentas_qtd": isentas,
+        "custo_total": custo_total,
+        "custo_isentas": custo_isentas,
+        "custo_pagas": custo_pagas,
+        "consumo_total_kwh": kwh_total,
+        "odometro_inicial": float(cols.odometro[0]) if n else 0.0,
+        "odometro_final": float(cols.odometro[-1]) if n else 0.0,
+    }
+
+
+def agregar_por_mes(cols, so_odometros_positivos=False):
+    """
+    Agrupa as recargas por mês. Retorna um dict de colunas (uma posição por mês):
+      meses, recargas, isentas, kwh, custo_total, custo_pagamento, odo_min, odo_max, odo_n
+    so_odometros_positivos: ignora leituras de odômetro zeradas (regra do dashboard).
+    """
+    if cols.vetorizado:
+        return _agregar_por_mes_numpy(cols, so_odometros_positivos)
+    return _agregar_por_mes_python(cols, so_odometros_positivos)
+
+
+def _agregar_por_mes_numpy(cols, so_odometros_positivos):
+    n = len(cols)
+    if n == 0:
+        vazio = np.zeros(0)
+        return {k: vazio for k in ("meses", "recargas", "isentas", "kwh", "custo_total",
+                                   "custo_pagamento", "odo_min", "odo_max", "odo_n")}
+    mes, kwh, custo, isento, odo = cols.mes, cols.kwh, cols.custo, cols.isento, cols.odometro
+    if np.any(mes[1:] < mes[:-1]):
+        ordem = np.argsort(mes, kind="stable")
+        mes, kwh, custo, isento, odo = mes[ordem], kwh[ordem], custo[ordem], isento[ordem], odo[ordem]
+
+    # Os meses estão ordenados: cada grupo é uma fatia contígua começando em 'inicio'
+    meses, inicio = np.unique(mes, return_index=True)
+    tamanhos = np.diff(np.append(inicio, n))
+    valido = odo > 0 if so_odometros_positivos else np.ones(n, dtype=bool)
+
+    # Reais/kWh somados na ordem do laço em Python, recomeçando a cada mês (ver _soma_sequencial):
+    # cada mês vira uma linha de uma matriz completada com 0.0 (x + 0.0 == x) e um único cumsum
+    # percorre as linhas. Diferenciar o cumsum da coluna inteira (c[fim - 1] - c[inicio - 1]) não
+    # dá o mesmo resultado: subtrai dois acumulados já arredondados, com erro na escala do total
+    # do histórico em vez do total do mês.
+    linha = np.repeat(np.arange(len(inicio)), tamanhos)
+    posicao = np.arange(n) - np.repeat(inicio, tamanhos)
+    matriz = np.zeros((3, len(inicio), tamanhos.max()))
+    matriz[:, linha, posicao] = (kwh, custo, np.where(isento, 0.0, custo))
+    kwh_mes, custo_mes, pagamento_mes = np.cumsum(matriz, axis=2)[:, :, -1]
+
+    return {
+        "meses": meses,
+        "recargas": tamanhos,
+        "isentas": np.add.reduceat(isento.astype(np.int64), inicio),
+        "kwh": kwh_mes,
+        "custo_total": custo_mes,
+        "custo_pagamento": pagamento_mes,
+        "odo_min": np.minimum.reduceat(np.where(valido, odo, np.inf), inicio),
+        "odo_max": np.maximum.reduceat(np.where(valido, odo, -np.inf), inicio),
+        "odo_n": np.add.reduceat(valido.astype(np.int64), inicio),
+    }
+
+
+def _agregar_por_mes_python(cols, so_odometros_positivos):
+    grupos = {}
+    for mes, kwh, custo, isento, odo in zip(cols.mes, cols.kwh, cols.custo, cols.isento, cols.odometro):
+        m = grupos.get(mes)
+        if m is None:
+            m = grupos[mes] = [0, 0, 0.0, 0.0, 0.0, float("inf"), float("-inf"), 0]
+        m[0] += 1
+        m[2] += kwh
+        m[3] += custo
+        if isento:
+            m[1] += 1
+        else:
+            m[4] += custo
+        if odo > 0 or not so_odometros_positivos:
+            m[5] = min(m[5], odo)
+            m[6] = max(m[6], odo)
+            m[7] += 1
+    meses = sorted(grupos)
+    colunas = list(zip(*(grupos[m] for m in meses))) if meses else [()] * 8
+    return dict(zip(("recargas", "isentas", "kwh", "custo_total", "custo_pagamento",
+                     "odo_min", "odo_max", "odo_n"), colunas), meses=meses)
+
+
+def km_por_mes(agg, regra):
+    """
+    Km rodados por mês a partir dos odômetros agregados.
+      regra='dashboard': max - min (2+ leituras) ou a própria leitura (1 leitura)
+      regra='serie':     max - min (2+ leituras) ou leitura - maior leitura do mês anterior
+    """
+    odo_min, odo_max, odo_n = agg["odo_min"], agg["odo_max"], agg["odo_n"]
+    if np is not None and isinstance(odo_n, np.ndarray):
+        with np.errstate(invalid="ignore"):
+            km = np.where(odo_n >= 2, odo_max - odo_min, 0.0)
+            um = odo_n == 1
+            if regra == "dashboard":
+                return np.where(um, odo_min, km)
+            prev_max = np.concatenate(([0.0], np.where(odo_n[:-1] > 0, odo_max[:-1], 0.0)))
+            tem_anterior = np.arange(len(km)) > 0
+            return np.where(um & tem_anterior, odo_min - prev_max, km)
+
+    km = []
+    for idx, (mn, mx, qtd) in enumerate(zip(odo_min, odo_max, odo_n)):
+        if qtd >= 2:
+            km.append(mx - mn)
+        elif qtd == 1 and regra == "dashboard":
+            km.append(mn)
+        elif qtd == 1 and idx > 0:
+            prev_max = odo_max[idx - 1] if odo_n[idx - 1] > 0 else 0.0
+            km.append(mn - prev_max)
+        else:
+            km.append(0.0)
+    return km
+
+
+def calcular_serie_mensal(cols, preco_gasolina=None, consumo_km_l=None):
+    """
+    Séries mensais do /api/recharges/monthly: custos, consumo, km, consumo/100km e economia.
+    Economia só é calculada quando há configuração de gasolina válida.
+    """
+    agg = agregar_por_mes(cols)
+    km = km_por_mes(agg, "serie")
+    ct, cp, kwh = agg["custo_total"], agg["custo_pagamento"], agg["kwh"]
+    tem_config = (preco_gasolina is not None) and (consumo_km_l is not None) and (consumo_km_l > 0)
+
+    if cols.vetorizado:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percentual = np.where(ct > 0, cp / ct * 100, 0.0)
+            consumo_100 = np.where(km > 0, kwh / km * 100, 0.0)
+        custo_gas = km / consumo_km_l * preco_gasolina if tem_config else None
+        economia_total = custo_gas - ct if tem_config else np.zeros(len(km))
+        economia_pagas = custo_gas - cp if tem_config else np.zeros(len(km))
+        series = (ct, cp, percentual, kwh, km, economia_total, economia_pagas, consumo_100)
+        series = [s.tolist() for s in series]
+        meses = agg["meses"].tolist()
+    else:
+        percentual = [(p / t * 100) if t > 0 else 0.0 for p, t in zip(cp, ct)]
+        consumo_100 = [(c / k * 100) if k > 0 else 0 for c, k in zip(kwh, km)]
+        if tem_config:
+            custo_gas = [k / consumo_km_l * preco_gasolina for k in km]
+            economia_total = [g_ - t for g_, t in zip(custo_gas, ct)]
+            economia_pagas = [g_ - p for g_, p in zip(custo_gas, cp)]
+        else:
+            economia_total = economia_pagas = [0.0] * len(km)
+        series = [list(ct), list(cp), percentual, list(kwh), list(km), economia_total, economia_pagas, consumo_100]
+        meses = agg["meses"]
+
+    # Arredondamento final com round() do Python (mesmo resultado nos dois motores)
+    ct, cp, percentual, kwh, km, economia_total, economia_pagas, consumo_100 = (
+        [round(v, 2) for v in s] for s in series)
+    return {
+        "labels": [rotulo_mes(m) for m in meses],
+        "custos": {"total": ct, "pagas": cp, "percentual": percentual},
+        "consumo": kwh,
+        "km": km,
+        "economia": {"total": economia_total, "pagas": economia_pagas},
+        "consumo_por_100km": [v if v > 0 else 0 for v in consumo_100],
+    }
+
+
 # ----------------- ROTAS -----------------
 @app.route("/")
 def index():
@@ -353,20 +1737,49 @@ def login():
     if form.validate_on_submit():
         email = form.email.data
         senha = form.senha.data
-        conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+
+        # Limite por IP/e-mail antes de qualquer acesso ao banco ou ao hash
+        espera = verificar_limite_login(email)
+        if espera is not None:
+            flash(_("Muitas tentativas de login. Tente novamente em alguns instantes."), "danger")
+            resposta = make_response(render_template("index.html", form=LoginForm()), 429)
+            resposta.headers['Retry-After'] = str(espera)
+            return resposta
+
+        conn = get_db()
         cursor = conn.cursor()
-        cursor.execute("SELECT id, nome, email, senha_hash FROM users WHERE email=%s", (email,))
+        # Usuário + configurações numa única consulta: o destino do redirect sai daqui mesmo
+        cursor.execute("""
+            SELECT u.id, u.nome, u.email, u.senha_hash, s.id, s.preco_gasolina, s.consumo_km_l
+            FROM users u
+            LEFT JOIN settings s ON s.user_id = u.id
+            WHERE u.email=%s
+        """, (email,))
         row = cursor.fetchone()
-        conn.close()
-        if row and check_password_hash(row[3], senha):
+        if row and verificar_senha(row[3], senha):
+            if precisa_rehash(row[3]):
+                # Política mudou (algoritmo ou custo): regrava com a senha em mãos.
+                # A condição em senha_hash evita sobrescrever uma troca de senha concorrente.
+                cursor.execute("UPDATE users SET senha_hash=%s WHERE id=%s AND senha_hash=%s",
+                               (gerar_hash_senha(senha), row[0], row[3]))
+                conn.commit()
+            # Login válido: erros de digitação anteriores não contam mais contra o e-mail
+            login_limiter().zerar(f'email:{email.strip().lower()}')
+            incrementar_metrica('login_sucesso_total')
             user = User(row[0], row[1], row[2])
             login_user(user)
             flash(_("Login realizado com sucesso!"), "success")
 
+            # Semeia os caches: a próxima request já encontra usuário e configurações
+            config = (row[5], row[6]) if row[4] is not None else _SEM_SETTINGS
+            cache_usuarios.set(user.id, user)
+            cache_settings.set(user.id, config)
+
             # Decide destino conforme configuração do usuário
-            destino = "dashboard" if has_complete_config(int(user.id)) else "account"
+            destino = "dashboard" if config and config_completa(*config) else "account"
             return redirect(url_for(destino))
         else:
+            incrementar_metrica('login_falha_total')
             flash(_("Credenciais inválidas."), "danger")
             return redirect(url_for("index"))
     for field, errors in form.errors.items():
@@ -381,18 +1794,17 @@ def register():
         if form.validate_on_submit():
             nome = form.nome.data
             email = form.email.data
-            senha_hash = generate_password_hash(form.senha.data)
-            conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+            senha_hash = gerar_hash_senha(form.senha.data)
+            conn = get_db()
             cursor = conn.cursor()
             try:
                 cursor.execute("INSERT INTO users (nome, email, senha_hash) VALUES (%s, %s, %s)", (nome, email, senha_hash))
                 conn.commit()
                 flash(_("Conta criada com sucesso! Faça login."), "success")
                 return redirect(url_for("index"))
-            except sqlite3.IntegrityError:
+            except psycopg2.IntegrityError:
+                conn.rollback()
                 flash(_("Email já cadastrado."), "danger")
-            finally:
-                conn.close()
         else:
             for field, errors in form.errors.items():
                 for err in errors:
@@ -419,14 +1831,16 @@ def recharge():
             local = form.local.data
             observacoes = form.observacoes.data
             isento = bool(form.isento.data)
-            conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+            conn = get_db()
             cursor = conn.cursor()
+            travar_recargas(cursor, int(current_user.id))
             cursor.execute("""
                 INSERT INTO recharges (user_id, data, kwh, custo, isento, odometro, local, observacoes)
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING data
             """, (int(current_user.id), data, kwh, custo, isento, odometro, local, observacoes))
+            recargas_alteradas(cursor, int(current_user.id), [cursor.fetchone()[0]])
             conn.commit()
-            conn.close()
             flash(_("Recarga registrada com sucesso!"), "success")
             return redirect(url_for("dashboard"))
         else:
@@ -452,14 +1866,19 @@ def bulk_recharge():
             return redirect(url_for("bulk_recharge"))
 
         # Inserção no banco
-        conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+        conn = get_db()
         cursor = conn.cursor()
+        travar_recargas(cursor, int(current_user.id))
         count_ok = 0
+        datas = []
         for r in rows:
+            # Savepoint por linha: uma linha recusada pelo banco não aborta a transação da importação
+            cursor.execute("SAVEPOINT linha_csv")
             try:
                 cursor.execute("""
                     INSERT INTO recharges (user_id, data, kwh, custo, isento, odometro, local, observacoes)
                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING data
                 """, (
                     int(current_user.id),
                     r['data'],
@@ -470,12 +1889,16 @@ def bulk_recharge():
                     r['local'],
                     r['observacoes']
                 ))
+                datas.append(cursor.fetchone()[0])
+                cursor.execute("RELEASE SAVEPOINT linha_csv")
                 count_ok += 1
             except Exception as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT linha_csv")
                 flash(_(f"Falha ao inserir linha: {r}. Detalhes: {e}"), "warning")
 
+        # Um único recálculo de km_delta e rollups, só para as recargas de fato inseridas
+        recargas_alteradas(cursor, int(current_user.id), datas)
         conn.commit()
-        conn.close()
 
         flash(_(f"Importação concluída. {count_ok} recarga(s) adicionada(s)."), "success")
         return redirect(url_for("dashboard"))
@@ -492,34 +1915,28 @@ def bulk_recharge():
 @login_required
 def account():
     form = AccountForm()
-    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
-    cursor = conn.cursor()
     if request.method == "POST":
         if form.validate_on_submit():
             preco_gasolina = form.preco_gasolina.data
             consumo_km_l = form.consumo_km_l.data
-            cursor.execute("SELECT id FROM settings WHERE user_id=%s", (int(current_user.id),))
-            row = cursor.fetchone()
-            if row:
-                cursor.execute("UPDATE settings SET preco_gasolina=%s, consumo_km_l=%s WHERE user_id=%s",
-                               (preco_gasolina, consumo_km_l, int(current_user.id)))
-            else:
-                cursor.execute("INSERT INTO settings (user_id, preco_gasolina, consumo_km_l) VALUES (%s, %s, %s)",
-                               (int(current_user.id), preco_gasolina, consumo_km_l))
-            conn.commit()
-            conn.close()
+            # Região do ranking entre usuários; vai no mesmo commit de salvar_settings()
+            get_db().cursor().execute("UPDATE users SET regiao=%s WHERE id=%s",
+                                      ((form.regiao.data or '').strip() or None, int(current_user.id)))
+            salvar_settings(int(current_user.id), preco_gasolina, consumo_km_l)
             flash(_("Configurações atualizadas com sucesso!"), "success")
             return redirect(url_for("dashboard"))
         else:
             for field, errors in form.errors.items():
                 for err in errors:
                     flash(_(f"Erro em {field}: {err}"), "danger")
-    cursor.execute("SELECT preco_gasolina, consumo_km_l FROM settings WHERE user_id=%s", (int(current_user.id),))
-    config = cursor.fetchone()
-    conn.close()
+    config = obter_settings(int(current_user.id))
     if config:
         form.preco_gasolina.data = float(config[0])
         form.consumo_km_l.data = float(config[1])
+    if not form.is_submitted():
+        cursor = get_db().cursor()
+        cursor.execute("SELECT regiao FROM users WHERE id=%s", (int(current_user.id),))
+        form.regiao.data = cursor.fetchone()[0]
     return render_template("account.html", form=form)
 
 
@@ -528,14 +1945,13 @@ def account():
 @login_required
 def api_recharges():
     user_id = int(current_user.id)
-    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    conn = get_db_leitura()
     cursor = conn.cursor()
     cursor.execute("SELECT data, kwh, custo, isento FROM recharges WHERE user_id=%s ORDER BY data", (user_id,))
     rows = cursor.fetchall()
-    conn.close()
     labels = [r[0] for r in rows]
-    kwh = [float(r[1]) for r in rows]
-    custo = [float(r[2]) for r in rows]
+    kwh = [r[1] for r in rows]
+    custo = [r[2] for r in rows]
     return jsonify({"labels": labels, "kwh": kwh, "custo": custo})
 
 
@@ -545,131 +1961,78 @@ def api_recharges():
 def api_recharges_monthly():
     user_id = int(current_user.id)
 
-    # Buscar dados do usuário
-    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    # Buscar dados do usuário (já em formato colunar)
+    conn = get_db_leitura()
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT data, kwh, custo, isento, odometro
-        FROM recharges
-        WHERE user_id=%s
-        ORDER BY CAST(data AS date), id
-    """, (user_id,))
-    rows = cursor.fetchall()
+    executar_preparado(cursor, 'recargas_colunas', SQL_COLUNAS_RECARGAS, (user_id,))
+    cols = carregar_colunas(cursor.fetchall())
 
-    # Buscar configurações para cálculo de economia
-    cursor.execute("SELECT preco_gasolina, consumo_km_l FROM settings WHERE user_id=%s", (user_id,))
-    config = cursor.fetchone()
-    conn.close()
+    # Configurações para cálculo de economia (cache do serviço de settings)
+    config = obter_settings(user_id)
 
     preco_gasolina = float(config[0]) if config and config[0] is not None else None
     consumo_km_l = float(config[1]) if config and config[1] is not None else None
-    tem_config = (preco_gasolina is not None) and (consumo_km_l is not None) and (consumo_km_l > 0)
 
-    # Estrutura para agregação
-    monthly = defaultdict(lambda: {
-        "custo_total": 0.0,
-        "custo_pagamento": 0.0,
-        "kwh": 0.0,
-        "odometros": []
-    })
-
-    # Processar linhas
-    for data, kwh, custo, isento, odometro in rows:
-        try:
-            mes = _to_month(data)  # 'YYYY-MM'
-        except Exception:
-            mes = str(data)[:7]
-
-        monthly[mes]["custo_total"] += float(custo or 0)
-        monthly[mes]["kwh"] += float(kwh or 0)
-        if odometro is not None:
-            monthly[mes]["odometros"].append(float(odometro))
-        if not isento:
-            monthly[mes]["custo_pagamento"] += float(custo or 0)
-
-    # Meses em ordem cronológica
-    meses_ord = sorted(monthly.keys())
-
-    # Vetores para resposta
-    labels = []
-    custos_total = []
-    custos_pagamento = []
-    custos_percentual = []
-    consumos = []
-    kms = []
-    economias_total = []
-    economias_pagamento = []
-    consumo_por_100km_list = []
-
-    # Calcular economia, km e consumo/100km por mês
-    for idx, mes in enumerate(meses_ord):
-        data_mes = monthly[mes]
-        labels.append(mes)
-
-        # Custos
-        ct = float(data_mes["custo_total"])
-        cp = float(data_mes["custo_pagamento"])
-        custos_total.append(round(ct, 2))
-        custos_pagamento.append(round(cp, 2))
-        custos_percentual.append(round((cp / ct * 100) if ct > 0 else 0.0, 2))
-
-        # Consumo
-        consumo_mes = round(float(data_mes["kwh"]), 2)
-        consumos.append(consumo_mes)
-
-        # Km rodados
-        odos = data_mes["odometros"]
-        if len(odos) >= 2:
-            km_mes = max(odos) - min(odos)
-        elif len(odos) == 1:
-            if idx > 0:
-                prev_odos = monthly[meses_ord[idx - 1]]["odometros"]
-                prev_last = max(prev_odos) if prev_odos else 0.0
-                km_mes = odos[0] - prev_last
-            else:
-                km_mes = 0.0
-        else:
-            km_mes = 0.0
+    # Custos, consumo, km, consumo/100km e economia por mês (vetorizado quando há NumPy)
+    return jsonify(calcular_serie_mensal(cols, preco_gasolina, consumo_km_l))
 
-        kms.append(round(km_mes, 2))
 
-        # Consumo / 100Km
-        if km_mes > 0:
-            consumo_por_100km_list.append(round((consumo_mes / km_mes) * 100, 2))
-        else:
-            consumo_por_100km_list.append(0)
+# ----------------- ROTA DASHBOARD -----------------
+def kpis_do_periodo(t, config):
+    """
+    KPIs de um período (mês do dashboard ou período de /api/recharges/compare) a partir dos totais
+    recargas, isentas, km, kwh, custo_total e custo_pagas. Economia só com configuração válida.
+    """
+    km = t["km"]
+    kpis = {
+        "recargas": t["recargas"],
+        "recargas_isentas_qtd": t["isentas"],
+        "recargas_pagas_qtd": t["recargas"] - t["isentas"],
+        "total_km": km,
+        "consumo_total_kwh": t["kwh"],
+        "consumo_por_100km": (t["kwh"] / km * 100) if km > 0 else 0,
+        "custo_total": t["custo_total"],
+        "custo_isentas": t["custo_total"] - t["custo_pagas"],
+        "custo_pagas": t["custo_pagas"],
+        "custo_medio_kwh": (t["custo_total"] / t["kwh"]) if t["kwh"] > 0 else 0,
+        "custo_medio_km": (t["custo_total"] / km) if km > 0 else 0,
+    }
+    if config and config[0] and config[1] and float(config[1]) > 0:
+        preco_gasolina, consumo_km_l = float(config[0]), float(config[1])
+        custo_gas_total = (km / consumo_km_l) * preco_gasolina
+        kpis.update({
+            "custo_gas_por_km": preco_gasolina / consumo_km_l,
+            "economia_total": custo_gas_total - t["custo_total"],
+            "economia_total_por_km": ((custo_gas_total - t["custo_total"]) / km) if km > 0 else 0,
+            "economia_pagas": custo_gas_total - t["custo_pagas"],
+            "economia_pagas_por_km": ((custo_gas_total - t["custo_pagas"]) / km) if km > 0 else 0,
+        })
+    else:
+        kpis.update({
+            "custo_gas_por_km": None,
+            "economia_total": None,
+            "economia_total_por_km": None,
+            "economia_pagas": None,
+            "economia_pagas_por_km": None,
+        })
+    return kpis
 
-        # Economia (dependente de config)
-        if tem_config:
-            custo_gas_mes = (km_mes / consumo_km_l) * preco_gasolina
-            economia_total_mes = custo_gas_mes - ct
-            economia_pagamento_mes = custo_gas_mes - cp
-        else:
-            economia_total_mes = 0.0
-            economia_pagamento_mes = 0.0
 
-        economias_total.append(round(economia_total_mes, 2))
-        economias_pagamento.append(round(economia_pagamento_mes, 2))
+def percent_change(curr, prev):
+    if prev is None or prev == 0: return None, 'flat'
+    delta = curr - prev
+    pct = (delta / prev) * 100
+    return round(pct, 1), 'up' if delta > 0 else ('down' if delta < 0 else 'flat')
 
-    # Resposta JSON
-    return jsonify({
-        "labels": labels,
-        "custos": {
-            "total": custos_total,
-            "pagas": custos_pagamento,
-            "percentual": custos_percentual
-        },
-        "consumo": consumos,
-        "km": kms,
-        "economia": {
-            "total": economias_total,
-            "pagas": economias_pagamento
-        },
-        "consumo_por_100km": consumo_por_100km_list
-    })
 
+def tendencias(curr_vals, prev_vals):
+    """Variação percentual e direção de cada KPI do período atual em relação ao anterior."""
+    trends = {}
+    for k in curr_vals.keys():
+        pct, direction = percent_change(curr_vals.get(k), prev_vals.get(k))
+        trends[k] = {"percent": pct, "direction": direction, "has_prev": prev_vals.get(k) is not None}
+    return trends
 
-# ----------------- ROTA DASHBOARD -----------------
 
 @app.route("/dashboard")
 @login_required
@@ -677,34 +2040,25 @@ def dashboard():
     user_id = int(current_user.id)
 
     # Carregar dados
-    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    conn = get_db_leitura()
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id, data, kwh, custo, isento, odometro, local, observacoes
-        FROM recharges
-        WHERE user_id=%s
-        ORDER BY CAST(data AS date), id
-    """, (user_id,))
-    recargas = cursor.fetchall()
+    executar_preparado(cursor, 'recargas_colunas', SQL_COLUNAS_RECARGAS, (user_id,))
+    cols = carregar_colunas(cursor.fetchall())
+    # Mediana e p90 vêm do sketch do usuário (uma linha), sem ordenar o histórico
+    percentis = percentis_usuario(cursor, user_id)
 
-    cursor.execute("SELECT preco_gasolina, consumo_km_l FROM settings WHERE user_id=%s", (user_id,))
-    config = cursor.fetchone()
-    conn.close()
-
-    # KPIs principais
-    kwhs = [float(r[2]) if r[2] else 0 for r in recargas]
-    custos = [float(r[3]) if r[3] else 0 for r in recargas]
-    isentos = [bool(r[4]) for r in recargas]
-    odometros = [float(r[5]) if r[5] else 0 for r in recargas]
+    config = obter_settings(user_id)
 
-    total_recargas = len(recargas)
-    recargas_isentas_qtd = sum(1 for i in isentos if i)
+    # KPIs principais (somas vetorizadas quando há NumPy)
+    totais = calcular_totais(cols)
+    total_recargas = totais["recargas"]
+    recargas_isentas_qtd = totais["recargas_isentas_qtd"]
     recargas_pagas_qtd = total_recargas - recargas_isentas_qtd
-    total_km = odometros[-1] - odometros[0] if len(odometros) >= 2 else (odometros[0] if odometros else 0)
-    custo_total = sum(custos)
-    custo_isentas = sum(c for c, i in zip(custos, isentos) if i)
-    custo_pagas = sum(c for c, i in zip(custos, isentos) if not i)
-    consumo_total_kwh = sum(kwhs)
+    total_km = (totais["odometro_final"] - totais["odometro_inicial"]) if total_recargas >= 2 else totais["odometro_final"]
+    custo_total = totais["custo_total"]
+    custo_isentas = totais["custo_isentas"]
+    custo_pagas = totais["custo_pagas"]
+    consumo_total_kwh = totais["consumo_total_kwh"]
     consumo_por_100km = (consumo_total_kwh / total_km * 100) if total_km > 0 else 0
     custo_medio_kwh = (custo_total / consumo_total_kwh) if consumo_total_kwh > 0 else 0
     custo_medio_km = (custo_total / total_km) if total_km > 0 else 0
@@ -747,116 +2101,184 @@ def dashboard():
         "economia_total_por_km": economia_total_por_km,
         "economia_pagas": economia_pagas,
         "economia_pagas_por_km": economia_pagas_por_km,
+        "custo_kwh_p50": percentis["custo_kwh"]["p50"],
+        "custo_kwh_p90": percentis["custo_kwh"]["p90"],
+        "consumo_100km_p50": percentis["consumo_100km"]["p50"],
+        "consumo_100km_p90": percentis["consumo_100km"]["p90"],
     }
 
     # ===== Cálculo das tendências =====
-    from collections import defaultdict
-    from datetime import datetime
-
-    monthly = defaultdict(lambda: {"count_total": 0, "count_isentas": 0, "count_pagas": 0,
-                                   "custo_total": 0, "custo_pagamento": 0, "kwh": 0, "odometros": []})
-
-    for (_id, data, kwh, custo, isento, odometro, *_rest) in recargas:
-        mes = _to_month(data)
-        monthly[mes]["count_total"] += 1
-        monthly[mes]["custo_total"] += float(custo or 0)
-        monthly[mes]["kwh"] += float(kwh or 0)
-        if odometro: monthly[mes]["odometros"].append(float(odometro))
-        if isento:
-            monthly[mes]["count_isentas"] += 1
-        else:
-            monthly[mes]["count_pagas"] += 1
-            monthly[mes]["custo_pagamento"] += float(custo or 0)
-
-    meses = sorted(monthly.keys())
-    curr_vals, prev_vals = {}, {}
-
-    # Função auxiliar
-    def percent_change(curr, prev):
-        if prev is None or prev == 0: return None, 'flat'
-        delta = curr - prev
-        pct = (delta / prev) * 100
-        return round(pct, 1), 'up' if delta > 0 else ('down' if delta < 0 else 'flat')
-
-    # Último mês
-    if meses:
-        m = monthly[meses[-1]]
-        km_mes = (max(m["odometros"]) - min(m["odometros"])) if len(m["odometros"]) >= 2 else (m["odometros"][0] if m["odometros"] else 0)
-        curr_vals = {
-            "recargas": m["count_total"],
-            "recargas_isentas_qtd": m["count_isentas"],
-            "recargas_pagas_qtd": m["count_pagas"],
-            "total_km": km_mes,
-            "consumo_total_kwh": m["kwh"],
-            "consumo_por_100km": (m["kwh"] / km_mes * 100) if km_mes > 0 else 0,
-            "custo_total": m["custo_total"],
-            "custo_isentas": m["custo_total"] - m["custo_pagamento"],
-            "custo_pagas": m["custo_pagamento"],
-            "custo_medio_kwh": (m["custo_total"] / m["kwh"]) if m["kwh"] > 0 else 0,
-            "custo_medio_km": (m["custo_total"] / km_mes) if km_mes > 0 else 0,
-        }
-        if tem_config:
-            custo_gas_por_km_mes = preco_gasolina / consumo_km_l if consumo_km_l > 0 else 0
-            custo_gas_total_mes = (km_mes / consumo_km_l) * preco_gasolina if consumo_km_l > 0 else 0
-            curr_vals.update({
-                "custo_gas_por_km": custo_gas_por_km_mes,
-                "economia_total": custo_gas_total_mes - m["custo_total"],
-                "economia_total_por_km": ((custo_gas_total_mes - m["custo_total"]) / km_mes) if km_mes > 0 else 0,
-                "economia_pagas": custo_gas_total_mes - m["custo_pagamento"],
-                "economia_pagas_por_km": ((custo_gas_total_mes - m["custo_pagamento"]) / km_mes) if km_mes > 0 else 0,
-            })
-        else:
-            curr_vals.update({
-                "custo_gas_por_km": None,
-                "economia_total": None,
-                "economia_total_por_km": None,
-                "economia_pagas": None,
-                "economia_pagas_por_km": None,
-            })
+    # Agrupamento mensal pelo motor de KPIs (odômetros zerados não contam no km do mês)
+    agg = agregar_por_mes(cols, so_odometros_positivos=True)
+    km_mensal = km_por_mes(agg, "dashboard")
+    meses = agg["meses"]
 
-    # Mês anterior
-    if len(meses) > 1:
-        m = monthly[meses[-2]]
-        km_mes = (max(m["odometros"]) - min(m["odometros"])) if len(m["odometros"]) >= 2 else (m["odometros"][0] if m["odometros"] else 0)
-        prev_vals = {
-            "recargas": m["count_total"],
-            "recargas_isentas_qtd": m["count_isentas"],
-            "recargas_pagas_qtd": m["count_pagas"],
-            "total_km": km_mes,
-            "consumo_total_kwh": m["kwh"],
-            "consumo_por_100km": (m["kwh"] / km_mes * 100) if km_mes > 0 else 0,
-            "custo_total": m["custo_total"],
-            "custo_isentas": m["custo_total"] - m["custo_pagamento"],
-            "custo_pagas": m["custo_pagamento"],
-            "custo_medio_kwh": (m["custo_total"] / m["kwh"]) if m["kwh"] > 0 else 0,
-            "custo_medio_km": (m["custo_total"] / km_mes) if km_mes > 0 else 0,
-        }
-        if tem_config:
-            custo_gas_por_km_mes = preco_gasolina / consumo_km_l if consumo_km_l > 0 else 0
-            custo_gas_total_mes = (km_mes / consumo_km_l) * preco_gasolina if consumo_km_l > 0 else 0
-            prev_vals.update({
-                "custo_gas_por_km": custo_gas_por_km_mes,
-                "economia_total": custo_gas_total_mes - m["custo_total"],
-                "economia_total_por_km": ((custo_gas_total_mes - m["custo_total"]) / km_mes) if km_mes > 0 else 0,
-                "economia_pagas": custo_gas_total_mes - m["custo_pagamento"],
-                "economia_pagas_por_km": ((custo_gas_total_mes - m["custo_pagamento"]) / km_mes) if km_mes > 0 else 0,
-            })
-        else:
-            prev_vals.update({
-                "custo_gas_por_km": None,
-                "economia_total": None,
-                "economia_total_por_km": None,
-                "economia_pagas": None,
-                "economia_pagas_por_km": None,
-            })
+    def mes_agregado(i):
+        # Converte para tipos do Python (o motor NumPy devolve escalares numpy)
+        return kpis_do_periodo({
+            "recargas": int(agg["recargas"][i]),
+            "isentas": int(agg["isentas"][i]),
+            "custo_total": float(agg["custo_total"][i]),
+            "custo_pagas": float(agg["custo_pagamento"][i]),
+            "kwh": float(agg["kwh"][i]),
+            "km": float(km_mensal[i]),
+        }, config)
 
-    # Monta tendências
-    trends = {}
-    for k in curr_vals.keys():
-        pct, direction = percent_change(curr_vals.get(k), prev_vals.get(k))
-        trends[k] = {"percent": pct, "direction": direction, "has_prev": prev_vals.get(k) is not None}
+    # Último mês x mês anterior
+    curr_vals = mes_agregado(-1) if len(meses) else {}
+    prev_vals = mes_agregado(-2) if len(meses) > 1 else {}
+    trends = tendencias(curr_vals, prev_vals)
+
+    return render_template("dashboard.html", kpis=kpis, trends=trends)
+
+
+# ----------------- COMPARAÇÃO DE PERÍODOS -----------------
+# Meses por período (a semana começa na segunda-feira)
+MESES_DO_PERIODO = {'month': 1, 'quarter': 3, 'year': 12}
+
+
+def periodos_comparados(periodo, params):
+    """
+    Intervalos [inicio, fim) do período atual e do anterior. 'ref' (padrão: hoje) escolhe o
+    período atual; em 'custom', date_from/date_to são obrigatórios e compare_from/compare_to
+    (padrão: o mesmo número de dias logo antes) definem o anterior. Datas inclusivas.
+    """
+    if periodo == 'custom':
+        inicio, ultimo = _data_filtro(params, 'date_from'), _data_filtro(params, 'date_to')
+        if inicio is None or ultimo is None or ultimo < inicio:
+            raise FiltroInvalido('date_from' if inicio is None else 'date_to')
+        fim = ultimo + timedelta(days=1)
+        inicio_ant, ultimo_ant = _data_filtro(params, 'compare_from'), _data_filtro(params, 'compare_to')
+        if inicio_ant is None and ultimo_ant is None:
+            return (inicio, fim), (inicio - (fim - inicio), inicio)
+        if inicio_ant is None or ultimo_ant is None or ultimo_ant < inicio_ant:
+            raise FiltroInvalido('compare_from' if inicio_ant is None else 'compare_to')
+        return (inicio, fim), (inicio_ant, ultimo_ant + timedelta(days=1))
+
+    ref = _data_filtro(params, 'ref') or date.today()
+    if periodo == 'week':
+        inicio = ref - timedelta(days=ref.weekday())
+        return (inicio, inicio + timedelta(days=7)), (inicio - timedelta(days=7), inicio)
+    n = MESES_DO_PERIODO[periodo]
+    inicio = _inicio_do_mes(ref, -((ref.month - 1) % n))
+    return (inicio, _inicio_do_mes(inicio, n)), (_inicio_do_mes(inicio, -n), inicio)
+
+
+@app.route("/api/recharges/compare")
+@login_required
+def api_recharges_compare():
+    """
+    KPIs de dois períodos e a variação entre eles, somados dos rollups (poucas linhas por período).
+    Parâmetros: period=week|month|quarter|year (com ref opcional) ou period=custom (date_from,
+    date_to, compare_from, compare_to). O km de um período é a soma de km_delta das suas recargas.
+    """
+    periodo = request.args.get('period', 'month')
+    if periodo not in ('week', 'custom') and periodo not in MESES_DO_PERIODO:
+        return jsonify({'error': 'invalid_period'}), 400
+    try:
+        atual, anterior = periodos_comparados(periodo, request.args)
+    except FiltroInvalido as e:
+        return jsonify({'error': 'invalid_filter', 'field': e.campo}), 400
 
-    return render_template("dashboard.html", recargas=recargas, kpis=kpis, trends=trends)
+    user_id = int(current_user.id)
+    cursor = get_db_leitura().cursor()
+    config = obter_settings(user_id)
+    resultado = {'period': periodo}
+    for chave, (inicio, fim) in (('current', atual), ('previous', anterior)):
+        resultado[chave] = {'from': inicio, 'to': fim - timedelta(days=1),
+                            'kpis': kpis_do_periodo(totais_periodo(cursor, user_id, inicio, fim), config)}
+    resultado['trends'] = tendencias(resultado['current']['kpis'], resultado['previous']['kpis'])
+    return jsonify(resultado)
+
+
+# ----------------- RANKING ENTRE USUÁRIOS (percentis globais e por região) -----------------
+# Um job agendado (flask --app app ranking-build, via cron/scheduler) lê os rollups mensais de todos
+# os usuários numa única consulta e grava os cortes p0..p100 de cada métrica, para todos ('') e para
+# cada região. "Onde eu fico" vira uma busca binária nesses cortes, qualquer que seja o número de usuários.
+# Grupos com menos de RANKING_MIN_USUARIOS não são publicados (não expõem dados de poucas pessoas).
+app.config['RANKING_MIN_USUARIOS'] = int(os.getenv('RANKING_MIN_USUARIOS', 5))
+
+METRICAS_RANKING = ('custo_kwh', 'consumo_100km')
+CORTES_RANKING = [i / 100 for i in range(101)]
+
+# Médias de cada usuário sobre todo o histórico, a partir das linhas mensais dos rollups
+SQL_RANKING_POR_USUARIO = """
+    SELECT r.user_id, lower(NULLIF(trim(u.regiao), '')) AS regiao,
+           SUM(r.custo_total) / NULLIF(SUM(r.kwh), 0) AS custo_kwh,
+           CASE WHEN SUM(r.km) > 0 THEN SUM(r.kwh) / SUM(r.km) * 100 END AS consumo_100km
+    FROM recharges_rollups r JOIN users u ON u.id = r.user_id
+    WHERE r.granularidade = 'm' {filtro}
+    GROUP BY r.user_id, u.regiao
+"""
+
+SQL_CONSTRUIR_RANKING = f"""
+    INSERT INTO ranking_percentis (regiao, metrica, usuarios, percentis)
+    SELECT COALESCE(p.regiao, ''), m.metrica, COUNT(*),
+           percentile_cont(%s::float8[]) WITHIN GROUP (ORDER BY m.valor)
+    FROM ({SQL_RANKING_POR_USUARIO.format(filtro='')}) p,
+         LATERAL (VALUES ('custo_kwh', p.custo_kwh), ('consumo_100km', p.consumo_100km)) AS m(metrica, valor)
+    WHERE m.valor IS NOT NULL
+    GROUP BY GROUPING SETS ((m.metrica), (m.metrica, p.regiao))
+    HAVING COUNT(*) >= %s AND (GROUPING(p.regiao) = 1 OR p.regiao IS NOT NULL)
+"""
+
+
+def construir_ranking(conn):
+    """Recalcula ranking_percentis numa transação: leitores veem a tabela antiga até o commit."""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM ranking_percentis")
+    cursor.execute(SQL_CONSTRUIR_RANKING, (CORTES_RANKING, app.config['RANKING_MIN_USUARIOS']))
+    grupos = cursor.rowcount
+    conn.commit()
+    return grupos
+
+
+@app.cli.command('ranking-build')
+def ranking_build_command():
+    """Recalcula os percentis globais e por região (rodar periodicamente, p.ex. uma vez por dia)."""
+    click.echo(f"{construir_ranking(get_db())} grupo(s) de percentis gravados")
+
+
+def posicao_no_ranking(valor, percentis):
+    """Percentual de usuários do grupo com valor menor que 'valor' (0 a 100)."""
+    return max(0, min(100, bisect.bisect_left(percentis, valor) - 1)) if valor is not None else None
+
+
+@app.route("/api/ranking")
+@login_required
+def api_ranking():
+    """
+    Onde o usuário fica em custo por kWh e consumo por 100 km, entre todos e na sua região.
+    'percentil' é o percentual de usuários com valor menor; grupos pequenos demais vêm como null.
+    """
+    user_id = int(current_user.id)
+    cursor = get_db_leitura().cursor()
+    executar_preparado(cursor, 'ranking_usuario',
+                       SQL_RANKING_POR_USUARIO.format(filtro='AND r.user_id = %s'), (user_id,))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute("SELECT lower(NULLIF(trim(regiao), '')) FROM users WHERE id=%s", (user_id,))
+        row = (user_id, cursor.fetchone()[0], None, None)
+    regiao, valores = row[1], dict(zip(METRICAS_RANKING, row[2:]))
+
+    cursor.execute("""
+        SELECT regiao, metrica, usuarios, percentis, calculado_em FROM ranking_percentis
+        WHERE regiao IN ('', %s)
+    """, (regiao or '',))
+    grupos, calculado_em = {}, None
+    for grupo, metrica, usuarios, percentis, quando in cursor.fetchall():
+        grupos[(grupo, metrica)] = {'usuarios': usuarios, 'mediana': percentis[50],
+                                    'percentil': posicao_no_ranking(valores[metrica], percentis)}
+        calculado_em = quando
+
+    return jsonify({
+        'regiao': regiao,
+        'calculado_em': calculado_em,
+        'metricas': {m: {'valor': valores[m],
+                         'global': grupos.get(('', m)),
+                         'regiao': grupos.get((regiao, m)) if regiao else None}
+                     for m in METRICAS_RANKING},
+    })
 
 
 # ----------------- ROTA MANAGE RECHARGES -----------------
@@ -867,6 +2289,21 @@ def manage_recharges():
 
 
 # ========== ENDPOINT 1: GET /api/manage_recharges ==========
+# Como obter o total da listagem: 'janela' (COUNT(*) OVER() na própria página),
+# 'separado' (COUNT + página) ou 'auto' (escolhe por request; ver benchmarks.py listagem)
+app.config['MANAGE_TOTAL'] = os.getenv('MANAGE_TOTAL', 'auto')
+
+
+def _total_em_separado(filtro):
+    modo = app.config['MANAGE_TOTAL']
+    if modo != 'auto':
+        return modo == 'separado'
+    # Medido em benchmarks.py listagem: a janela impede o top-N do LIMIT (ordena/lê todas as linhas
+    # filtradas), o que só compensa quando o filtro é caro de avaliar duas vezes (LIKE em local/observações).
+    # Sem filtro de texto, COUNT pelo índice (user_id, data) + página ordenada é mais barato.
+    return not set(filtro.forma) & {'local', 'observacoes'}
+
+
 @app.route('/api/manage_recharges')
 @login_required
 def api_manage_recharges():
@@ -875,65 +2312,44 @@ def api_manage_recharges():
     sort_by = request.args.get('sort_by', 'data')
     sort_dir = request.args.get('sort_dir', 'asc')
 
-    # Filtros
-    local = request.args.get('local', '').strip()
-    observacoes = request.args.get('observacoes', '').strip()
-    isento = request.args.get('isento', 'all')
-    date_from = request.args.get('date_from')
-    date_to = request.args.get('date_to')
-
     # Validação sort_by
     valid_sort = ['data', 'kwh', 'custo', 'isento', 'odometro', 'local', 'observacoes']
     if sort_by not in valid_sort:
         sort_by = 'data'
     sort_dir = 'desc' if sort_dir == 'desc' else 'asc'
 
-    user_id = int(current_user.id)
-    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    try:
+        filtro = FiltroRecargas.de_parametros(request.args)
+    except FiltroInvalido as e:
+        return jsonify({'error': 'invalid_filter', 'field': e.campo}), 400
+    _, params = compilar_filtro(int(current_user.id), filtro)
+
+    conn = get_db_leitura()
     cursor = conn.cursor()
 
-    # Monta cláusula WHERE
-    where_clauses = ['user_id=%s']
-    params = [user_id]
-    if local:
-        where_clauses.append('LOWER(local) LIKE %s')
-        params.append(f'%{local.lower()}%')
-    if observacoes:
-        where_clauses.append('LOWER(observacoes) LIKE %s')
-        params.append(f'%{observacoes.lower()}%')
-    if isento in ['true', 'false']:
-        where_clauses.append('isento=%s')
-        params.append(isento == 'true')
-    if date_from:
-        where_clauses.append('CAST(data AS date) >= date(%s)')
-        params.append(date_from)
-    if date_to:
-        where_clauses.append('CAST(data AS date) <= date(%s)')
-        params.append(date_to)
-
-    where_sql = ' AND '.join(where_clauses)
-
-    # Conta total
-    cursor.execute(f'SELECT COUNT(*) FROM recharges WHERE {where_sql}', params)
-    total = cursor.fetchone()[0]
-
-    # Busca paginada
     offset = (page - 1) * page_size
-    cursor.execute(f'''
-        SELECT id, data, kwh, custo, isento, odometro, local, observacoes
-        FROM recharges WHERE {where_sql}
-        ORDER BY {sort_by} {sort_dir}
-        LIMIT %s OFFSET %s
-    ''', params + [page_size, offset])
-    rows = cursor.fetchall()
-    conn.close()
-
-    items = []
-    for r in rows:
-        items.append({
-            'id': r[0], 'data': r[1], 'kwh': r[2], 'custo': r[3],
-            'isento': bool(r[4]), 'odometro': r[5], 'local': r[6], 'observacoes': r[7]
-        })
+    if _total_em_separado(filtro):
+        # Conta total
+        executar_preparado(cursor, 'listagem_total', sql_total_recargas(filtro.forma), params)
+        total = cursor.fetchone()[0]
+
+        # Busca paginada
+        executar_preparado(cursor, 'listagem_pagina', sql_pagina_recargas(filtro.forma, sort_by, sort_dir),
+                           params + [page_size, offset])
+        items = [Recharge(*r) for r in cursor.fetchall()]
+    else:
+        executar_preparado(cursor, 'listagem_janela', sql_pagina_com_total(filtro.forma, sort_by, sort_dir),
+                           params + [page_size, offset])
+        rows = cursor.fetchall()
+        items = [Recharge(*r[:-1]) for r in rows]
+        if rows:
+            total = rows[0][-1]
+        elif offset:
+            # Página além do fim: sem linhas a janela não informa o total
+            executar_preparado(cursor, 'listagem_total', sql_total_recargas(filtro.forma), params)
+            total = cursor.fetchone()[0]
+        else:
+            total = 0
 
     return jsonify({
         'items': items,
@@ -975,141 +2391,363 @@ def api_update_recharge(recarga_id):
     if errors:
         return jsonify({'error': 'validation_failed', 'fields': errors}), 400
 
-    # Atualiza no banco
-    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    # Atualiza e devolve a linha num único comando; o dono é verificado no próprio WHERE.
+    # A CTE devolve também a data anterior: os derivados são refeitos para as duas datas.
+    user_id = int(current_user.id)
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM recharges WHERE id=%s', (recarga_id,))
-    row = cursor.fetchone()
-    if not row:
-        conn.close()
-        return jsonify({'error': 'not_found'}), 404
-    if row[0] != int(current_user.id):
-        conn.close()
-        return jsonify({'error': 'forbidden'}), 403
-
-    cursor.execute('''
-        UPDATE recharges SET data=%s, kwh=%s, custo=%s, isento=%s, odometro=%s, local=%s, observacoes=%s WHERE id=%s
+    travar_recargas(cursor, user_id)
+    cursor.execute(f'''
+        WITH antes AS (SELECT id AS id_antes, data AS data_antes FROM recharges
+                       WHERE id=%s AND user_id=%s FOR UPDATE)
+        UPDATE recharges SET data=%s, kwh=%s, custo=%s, isento=%s, odometro=%s, local=%s, observacoes=%s
+        FROM antes WHERE id = id_antes
+        RETURNING {SQL_CAMPOS_RECARGA}, data_antes
     ''', (
-        data['data'], kwh, custo, data.get('isento', False),
-        odometro, data.get('local', ''), data.get('observacoes', ''), recarga_id
+        recarga_id, user_id, data['data'], kwh, custo, data.get('isento', False),
+        odometro, data.get('local', ''), data.get('observacoes', '')
     ))
+    row = cursor.fetchone()
+    if not row:
+        conn.rollback()
+        return _erro_recarga_nao_alterada(cursor, recarga_id)
+    recargas_alteradas(cursor, user_id, [row[1], row[-1]])
     conn.commit()
 
-    cursor.execute('SELECT id, data, kwh, custo, isento, odometro, local, observacoes FROM recharges WHERE id=%s', (recarga_id,))
-    r = cursor.fetchone()
-    conn.close()
-
-    return jsonify({'updated': True, 'item': {
-        'id': r[0], 'data': r[1], 'kwh': r[2], 'custo': r[3],
-        'isento': bool(r[4]), 'odometro': r[5], 'local': r[6], 'observacoes': r[7]
-    }})
+    return jsonify({'updated': True, 'item': Recharge(*row[:-1])})
 
 # ========== ENDPOINT 3: DELETE /api/manage_recharges/<id> ==========
 @app.route('/api/manage_recharges/<int:recarga_id>', methods=['DELETE'])
 @login_required
 @csrf.exempt
 def api_delete_recharge(recarga_id):
-    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    user_id = int(current_user.id)
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM recharges WHERE id=%s', (recarga_id,))
+    travar_recargas(cursor, user_id)
+    cursor.execute('DELETE FROM recharges WHERE id=%s AND user_id=%s RETURNING data',
+                   (recarga_id, user_id))
     row = cursor.fetchone()
     if not row:
-        conn.close()
-        return jsonify({'error': 'not_found'}), 404
-    if row[0] != int(current_user.id):
-        conn.close()
-        return jsonify({'error': 'forbidden'}), 403
-
-    cursor.execute('DELETE FROM recharges WHERE id=%s', (recarga_id,))
+        conn.rollback()
+        return _erro_recarga_nao_alterada(cursor, recarga_id)
+    # A sucessora passa a apontar para a recarga anterior à excluída
+    recargas_alteradas(cursor, user_id, [row[0]])
     conn.commit()
-    conn.close()
     return jsonify({'deleted': True})
 
 
+def _erro_recarga_nao_alterada(cursor, recarga_id):
+    """Nada foi alterado: distingue recarga inexistente (404) de recarga de outro usuário (403)."""
+    cursor.execute('SELECT 1 FROM recharges WHERE id=%s', (recarga_id,))
+    if cursor.fetchone():
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify({'error': 'not_found'}), 404
 
-# ----------------- ROTA EXPORTAR RECHARGES CSV -----------------
-@app.route('/export_recharges')
+
+# ========== ENDPOINT 4: POST /api/manage_recharges/bulk ==========
+app.config['BULK_MAX_IDS'] = int(os.getenv('BULK_MAX_IDS', 5000))
+CAMPOS_EDITAVEIS = ('data', 'kwh', 'custo', 'isento', 'odometro', 'local', 'observacoes')
+
+
+def _validar_campos_lote(campos):
+    """Valida um subconjunto dos campos editáveis com as mesmas regras do PATCH; retorna (valores, erros)."""
+    valores, errors = {}, {}
+    for f, valor in campos.items():
+        if f in ('data', 'kwh', 'custo', 'odometro') and (valor is None or str(valor).strip() == ''):
+            errors[f] = _('Campo obrigatório')
+        elif f in ('kwh', 'custo', 'odometro'):
+            valores[f] = float(valor)  # ValueError/TypeError tratados pelo chamador
+        elif f == 'isento':
+            # Só booleanos do JSON: bool("false") seria True
+            if isinstance(valor, bool):
+                valores[f] = valor
+            else:
+                errors[f] = _('Valor inválido')
+        elif f == 'data':
+            if isinstance(valor, str):
+                valores[f] = valor
+            else:
+                errors[f] = _('Valor inválido')
+        else:
+            valores[f] = str(valor or '')
+    if valores.get('kwh', 1) <= 0: errors['kwh'] = _('Deve ser > 0')
+    if valores.get('custo', 0) < 0: errors['custo'] = _('Não pode ser negativo')
+    if valores.get('odometro', 1) <= 0: errors['odometro'] = _('Deve ser > 0')
+    return valores, errors
+
+
+@app.route('/api/manage_recharges/bulk', methods=['POST'])
 @login_required
-def export_recharges():
-    # Captura filtros
-    local = request.args.get('local', '').strip()
-    observacoes = request.args.get('observacoes', '').strip()
-    isento = request.args.get('isento', 'all')
-    date_from = request.args.get('date_from')
-    date_to = request.args.get('date_to')
+@csrf.exempt
+def api_bulk_recharges():
+    """
+    Exclui, marca como isentas ou altera várias recargas num único comando (uma transação).
+    Payload: {"action": "delete" | "set_isento" | "update",
+              "ids": [...] ou "filters": {local, observacoes, isento, date_from, date_to},
+              "isento": true/false (set_isento), "fields": {...} (update)}
+    Ids de outros usuários ou inexistentes são ignorados; a resposta lista os ids afetados.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'invalid_payload'}), 400
+    action = data.get('action')
+    if action not in ('delete', 'set_isento', 'update'):
+        return jsonify({'error': 'invalid_action'}), 400
 
+    # Alvo: lista de ids ou os mesmos filtros da listagem (o dono vai sempre no WHERE)
     user_id = int(current_user.id)
-    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    if 'ids' in data:
+        ids = data['ids']
+        if not isinstance(ids, list) or not ids or len(ids) > app.config['BULK_MAX_IDS']:
+            return jsonify({'error': 'invalid_ids'}), 400
+        try:
+            ids = [int(i) for i in ids]
+        except (TypeError, ValueError):
+            return jsonify({'error': 'invalid_ids'}), 400
+        where_sql, params = 'user_id=%s AND id = ANY(%s)', [user_id, ids]
+    elif isinstance(data.get('filters'), dict):
+        try:
+            filtro = FiltroRecargas.de_parametros(data['filters'])
+        except FiltroInvalido as e:
+            return jsonify({'error': 'invalid_filter', 'field': e.campo}), 400
+        if not filtro.aplicado:
+            # Sem nenhum filtro o lote pegaria todas as recargas do usuário
+            return jsonify({'error': 'empty_filters'}), 400
+        where_sql, params = compilar_filtro(user_id, filtro)
+    else:
+        return jsonify({'error': 'missing_target'}), 400
+
+    # Alterações
+    if action == 'set_isento':
+        if not isinstance(data.get('isento', True), bool):
+            return jsonify({'error': 'invalid_payload'}), 400
+        valores = {'isento': data.get('isento', True)}
+    elif action == 'update':
+        campos = data.get('fields')
+        if not isinstance(campos, dict) or not campos:
+            return jsonify({'error': 'invalid_payload'}), 400
+        desconhecidos = sorted(set(campos) - set(CAMPOS_EDITAVEIS))
+        if desconhecidos:
+            return jsonify({'error': 'unknown_fields', 'fields': desconhecidos}), 400
+        try:
+            valores, errors = _validar_campos_lote(campos)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'invalid_number_format'}), 400
+        if errors:
+            return jsonify({'error': 'validation_failed', 'fields': errors}), 400
+
+    conn = get_db()
     cursor = conn.cursor()
+    travar_recargas(cursor, user_id)
+    try:
+        if action == 'delete':
+            cursor.execute(f'DELETE FROM recharges WHERE {where_sql} RETURNING id, data', params)
+        else:
+            # Como no PATCH, a CTE traz a data anterior de cada linha para o recálculo dos derivados
+            set_sql = ', '.join(f'{campo}=%s' for campo in valores)
+            cursor.execute(f'''
+                WITH antes AS (SELECT id AS id_antes, data AS data_antes FROM recharges
+                               WHERE {where_sql} FOR UPDATE)
+                UPDATE recharges SET {set_sql} FROM antes WHERE id = id_antes
+                RETURNING id, data, data_antes
+            ''', params + list(valores.values()))
+        linhas = cursor.fetchall()
+        recargas_alteradas(cursor, user_id, [d for r in linhas for d in r[1:]],
+                           km=action == 'delete' or bool({'data', 'odometro'} & set(valores)))
+    except psycopg2.DataError:
+        # Data inválida nos campos
+        conn.rollback()
+        return jsonify({'error': 'invalid_value'}), 400
+    conn.commit()
+    afetados = [r[0] for r in linhas]
 
-    # WHERE
-    where_clauses = ['user_id=%s']
-    params = [user_id]
-    if local:
-        where_clauses.append('LOWER(local) LIKE %s')
-        params.append(f'%{local.lower()}%')
-    if observacoes:
-        where_clauses.append('LOWER(observacoes) LIKE %s')
-        params.append(f'%{observacoes.lower()}%')
-    if isento in ['true', 'false']:
-        where_clauses.append('isento=%s')
-        params.append(1 if isento == 'true' else 0)
-    if date_from:
-        where_clauses.append('CAST(data AS date) >= date(%s)')  # ✅ sem entidades HTML
-        params.append(date_from)
-    if date_to:
-        where_clauses.append('CAST(data AS date) <= date(%s)')  # ✅ sem entidades HTML
-        params.append(date_to)
-
-    where_sql = ' AND '.join(where_clauses)
+    return jsonify({'action': action, 'affected': len(afetados), 'ids': afetados})
 
-    cursor.execute(f'''
-        SELECT data, kwh, custo, isento, odometro, local, observacoes
-        FROM recharges
-        WHERE {where_sql}
-        ORDER BY CAST(data AS date), id
-    ''', params)
-    rows = cursor.fetchall()
-    conn.close()
-
-    # CSV em memória (newline='' evita linhas em branco em alguns ambientes)
-    output = io.StringIO(newline='')
-    writer = csv.writer(output)
-    writer.writerow(['data', 'kwh', 'custo', 'isento', 'odometro', 'local', 'observacoes'])
-    for data, kwh, custo, isento, odometro, local_val, obs in rows:
-        writer.writerow([
-            data,
-            kwh,
-            custo,
-            True if isento else False,
-            odometro,
-            local_val or '',
-            obs or ''
-        ])
+
+
+# ----------------- ROTA EXPORTAR RECHARGES CSV -----------------
+# Linhas lidas do banco (FETCH do cursor no servidor) e enviadas por bloco do CSV
+EXPORT_LINHAS_POR_BLOCO = 1000
+
+
+@app.route('/export_recharges')
+@login_required
+def export_recharges():
+    # Mesmos filtros (e mesmo SQL por forma) da listagem
+    try:
+        filtro = FiltroRecargas.de_parametros(request.args)
+    except FiltroInvalido as e:
+        return jsonify({'error': 'invalid_filter', 'field': e.campo}), 400
+    _, params = compilar_filtro(int(current_user.id), filtro)
+
+    # Cursor nomeado (no servidor): o resultado não é carregado inteiro na memória do worker
+    conn = get_db_leitura()
+    cursor = conn.cursor(name='exportar_recargas')
+    cursor.execute(sql_exportar_recargas(filtro.forma), params)
+
+    def gerar_csv():
+        # Um bloco do CSV por FETCH (newline='' evita linhas em branco em alguns ambientes)
+        output = io.StringIO(newline='')
+        writer = csv.writer(output)
+        writer.writerow(['data', 'kwh', 'custo', 'isento', 'odometro', 'local', 'observacoes'])
+        while True:
+            linhas = cursor.fetchmany(EXPORT_LINHAS_POR_BLOCO)
+            writer.writerows(Recharge(*r).linha_csv() for r in linhas)
+            if output.tell():
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate()
+            if not linhas:
+                break
 
     # Decide o nome do arquivo conforme filtros
-    filtros_aplicados = any([
-        bool(local),
-        bool(observacoes),
-        isento in ['true', 'false'],
-        bool(date_from),
-        bool(date_to)
-    ])
     filename = (
         'recharge_export_filtered.csv'
-        if filtros_aplicados
+        if filtro.aplicado
         else 'recharge_export_complete.csv'
     )
 
-    # Retorna como arquivo para download
+    # Retorna como arquivo para download, em streaming (a compressão também é feita por bloco);
+    # stream_with_context mantém o request, e a conexão do pool, até o último bloco
     return Response(
-        output.getvalue(),
+        stream_with_context(gerar_csv()),
         mimetype='text/csv; charset=utf-8',
         headers={'Content-Disposition': f'attachment; filename={filename}'}
     )
 
 
 
+# ----------------- FILA DE E-MAILS (outbox + worker) -----------------
+# As rotas só gravam em mail_outbox; o envio é feito pelo worker ('flask --app app mail-worker'),
+# fora dos workers web, reaproveitando a conexão SMTP por lote e com novas tentativas.
+app.config['MAIL_OUTBOX_LOTE'] = int(os.getenv('MAIL_OUTBOX_LOTE', 20))
+app.config['MAIL_OUTBOX_MAX_TENTATIVAS'] = int(os.getenv('MAIL_OUTBOX_MAX_TENTATIVAS', 6))
+app.config['MAIL_OUTBOX_BACKOFF_BASE'] = int(os.getenv('MAIL_OUTBOX_BACKOFF_BASE', 30))      # segundos
+app.config['MAIL_OUTBOX_BACKOFF_MAX'] = int(os.getenv('MAIL_OUTBOX_BACKOFF_MAX', 3600))     # segundos
+app.config['MAIL_OUTBOX_POLL'] = int(os.getenv('MAIL_OUTBOX_POLL', 30))                    # segundos
+
+
+def enfileirar_email(cursor, assunto, corpo, destinatarios, reply_to=None, contact_log_id=None):
+    """Grava o e-mail na outbox (na transação de quem chamou) e acorda o worker no commit."""
+    destinatarios = [d for d in destinatarios if d]
+    if not destinatarios:
+        # Sem endereço o worker nunca conseguiria enviar: falha aqui, na rota, e não na fila
+        raise ValueError('e-mail sem destinatário')
+    cursor.execute('''
+        INSERT INTO mail_outbox (contact_log_id, assunto, remetente, destinatarios, reply_to, corpo)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    ''', (contact_log_id, assunto, app.config['MAIL_USERNAME'], ','.join(destinatarios), reply_to, corpo))
+    cursor.execute('NOTIFY mail_outbox')
+
+
+def _backoff_outbox(tentativas):
+    """Espera até a próxima tentativa: base * 2^(n-1), limitada ao máximo."""
+    return min(app.config['MAIL_OUTBOX_BACKOFF_BASE'] * 2 ** (tentativas - 1),
+               app.config['MAIL_OUTBOX_BACKOFF_MAX'])
+
+
+def _registrar_envio(cursor, item, erro, definitivo=False):
+    """
+    Atualiza a outbox e o contact_logs.status conforme o resultado do envio. Depois de
+    MAIL_OUTBOX_MAX_TENTATIVAS falhas (ou de um erro definitivo) o item vira 'falhou' e sai da fila.
+    """
+    outbox_id, contact_log_id, tentativas = item[0], item[1], item[7] + 1
+    if erro is None:
+        cursor.execute('''
+            UPDATE mail_outbox SET status='enviado', tentativas=%s, enviado_em=NOW(), ultimo_erro=NULL
+            WHERE id=%s
+        ''', (tentativas, outbox_id))
+        status_log = 'sucesso'
+    elif definitivo or tentativas >= app.config['MAIL_OUTBOX_MAX_TENTATIVAS']:
+        cursor.execute('''
+            UPDATE mail_outbox SET status='falhou', tentativas=%s, ultimo_erro=%s WHERE id=%s
+        ''', (tentativas, str(erro), outbox_id))
+        status_log = f'erro: {erro}'[:50]
+    else:
+        cursor.execute('''
+            UPDATE mail_outbox
+            SET tentativas=%s, ultimo_erro=%s, proxima_tentativa=NOW() + %s * INTERVAL '1 second'
+            WHERE id=%s
+        ''', (tentativas, str(erro), _backoff_outbox(tentativas), outbox_id))
+        status_log = f'pendente ({tentativas} falha(s))'
+    if contact_log_id is not None:
+        cursor.execute('UPDATE contact_logs SET status=%s WHERE id=%s', (status_log, contact_log_id))
+
+
+def processar_outbox(conn):
+    """
+    Envia um lote de e-mails vencidos numa única conexão SMTP.
+    As linhas ficam travadas (SKIP LOCKED) até o commit: vários workers não enviam o mesmo e-mail.
+    Retorna quantos itens foram processados.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, contact_log_id, assunto, remetente, destinatarios, reply_to, corpo, tentativas
+        FROM mail_outbox
+        WHERE status='pendente' AND proxima_tentativa <= NOW()
+        ORDER BY id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ''', (app.config['MAIL_OUTBOX_LOTE'],))
+    itens = cursor.fetchall()
+    if not itens:
+        conn.commit()
+        return 0
+
+    # Itens sem destinatário (gravados antes da checagem em enfileirar_email) nunca seriam enviados
+    pendentes = []
+    for item in itens:
+        if item[4]:
+            pendentes.append(item)
+        else:
+            _registrar_envio(cursor, item, 'sem destinatário', definitivo=True)
+    if not pendentes:
+        conn.commit()
+        return len(itens)
+    try:
+        with mail.connect() as smtp:
+            while pendentes:
+                item = pendentes[0]
+                erro, definitivo = None, False
+                try:
+                    smtp.send(Message(subject=item[2], sender=item[3], recipients=item[4].split(','),
+                                      reply_to=item[5], body=item[6]))
+                except smtplib.SMTPServerDisconnected:
+                    # Conexão caiu: o restante do lote é reagendado abaixo
+                    raise
+                except smtplib.SMTPRecipientsRefused as e:
+                    # Endereço recusado pelo servidor: repetir não muda o resultado
+                    erro, definitivo = e, True
+                except Exception as e:
+                    erro = e
+                _registrar_envio(cursor, pendentes.pop(0), erro, definitivo)
+    except Exception as e:
+        # Falha ao conectar/autenticar (ou queda no meio do lote)
+        for item in pendentes:
+            _registrar_envio(cursor, item, e)
+    conn.commit()
+    return len(itens)
+
+
+@app.cli.command('mail-worker')
+@click.option('--uma-vez', is_flag=True, help='Processa o que estiver vencido e sai (útil em cron/testes).')
+def mail_worker_command(uma_vez):
+    """Envia os e-mails da outbox (acordado por NOTIFY ou a cada MAIL_OUTBOX_POLL segundos)."""
+    conn = get_db()
+    conn.cursor().execute('LISTEN mail_outbox')
+    conn.commit()
+    while True:
+        while processar_outbox(conn):
+            pass
+        if uma_vez:
+            return
+        # Dorme até um NOTIFY de enfileirar_email() ou até vencer alguma nova tentativa
+        if select.select([conn], [], [], app.config['MAIL_OUTBOX_POLL']) != ([], [], []):
+            conn.poll()
+            conn.notifies.clear()
+
+
 # ----------------- ENVIAR MENSAGEM AO CRIADOR -----------------
 @app.route('/contact', methods=['GET', 'POST'])
 @login_required
@@ -1123,46 +2761,34 @@ def contact():
         nome = form.nome.data
         email = form.email.data
         mensagem = form.mensagem.data # <-- A variável 'mensagem' agora está definida aqui
+        destinatario = app.config['MAIL_CONTACT_TO']
 
-        # --- Atribuir a mensagem a uma variável 'msg' ---
-        msg = Message(
-            subject=f'EVChargeLog.com - {nome}',
-            sender=os.getenv('MAIL_USERNAME'),  # usa seu e-mail para evitar rejeição
-            recipients=[os.getenv('MAIL_USERNAME')],
-            body=f'Nome: {nome}\nEmail: {email}\n\nMensagem:\n{mensagem}'
-        )
-
-        status = 'sucesso'
-
-        '''
-        try:
-            # Envia a mensagem
-            mail.send(msg)
-            flash('Mensagem enviada com sucesso!')
-        except Exception as e:
-            status = f'erro: {str(e)}'
-            flash('Erro ao enviar mensagem. Tente novamente mais tarde.')
-        '''
-        
-        # Log no SQLite
-        conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+        # Log + e-mail na outbox na mesma transação; o envio fica com o mail-worker
+        conn = get_db()
         cursor = conn.cursor()
-        
-        # --- Usar isoformat() para o tipo TIMESTAMP no SQLITE ---
-        # data_envio = datetime.now().isoformat() 
-
-        # --- Usar isoformat() para o tipo TIMESTAMP no POSTGRES ---
-        data_envio = datetime.now(timezone.utc)
-
         cursor.execute('''
             INSERT INTO contact_logs (nome, email, mensagem, data_envio, status)
             VALUES (%s, %s, %s, %s, %s)
-        ''', (nome, email, mensagem, data_envio, status))
-        
+            RETURNING id
+        ''', (nome, email, mensagem, datetime.now(timezone.utc),
+              'pendente' if destinatario else 'erro: sem destinatário'))
+        contact_log_id = cursor.fetchone()[0]
+        if not destinatario:
+            # Sem MAIL_CONTACT_TO/MAIL_USERNAME: a mensagem fica só no contact_logs, fora da fila
+            conn.commit()
+            app.logger.error('MAIL_CONTACT_TO não configurado: mensagem de contato %s não enviada', contact_log_id)
+            flash(_('O envio de mensagens está indisponível no momento. Tente novamente mais tarde.'), 'danger')
+            return render_template('contact.html', form=form)
+        enfileirar_email(
+            cursor,
+            assunto=f'EVChargeLog.com - {nome}',
+            corpo=f'Nome: {nome}\nEmail: {email}\n\nMensagem:\n{mensagem}',
+            destinatarios=[destinatario],
+            reply_to=email,
+            contact_log_id=contact_log_id,
+        )
         conn.commit()
-        conn.close()
 
-        # Simula envio bem-sucedido
         flash(_('Mensagem enviada com sucesso!'))
 
         # Redireciona para evitar reenvio do formulário ao atualizar a página
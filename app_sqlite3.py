@@ -10,9 +10,16 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import csv
 import io
+import json
 import os
+import queue
+import threading
 from collections import defaultdict
-from datetime import datetime
+from concurrent.futures import Future
+from datetime import date, datetime
+
+# Os templates são compartilhados com o app.py: bundles de assets e textos do JS por idioma
+import assets
 
 # ----------------- CONFIGURAÇÕES INICIAIS DO FLASK -----------------
 app = Flask(__name__)
@@ -66,6 +73,10 @@ def get_locale():
 babel = Babel(app, locale_selector=get_locale)
 
 
+# ----------------- ASSETS E TEXTOS DO JAVASCRIPT -----------------
+assets.init_app(app)
+
+
 # ----------------- Proteção CSRF -----------------
 csrf = CSRFProtect(app)
 
@@ -74,6 +85,140 @@ login_manager = LoginManager(app)
 login_manager.login_view = "index"
 
 
+# ----------------- CONEXÃO COM O BANCO (modo produção) -----------------
+# WAL: leituras do dashboard não esperam as escritas (nem o contrário); synchronous=NORMAL é seguro
+# com WAL e evita um fsync por commit. Busy timeout em vez de 'database is locked' imediato quando
+# outro worker do gunicorn está escrevendo.
+# Cada thread reaproveita a sua conexão de leitura (cache de comandos e de páginas sobrevive entre
+# requests); as escritas do processo passam por uma única thread escritora, que agrupa o que estiver
+# na fila numa só transação.
+app.config['SQLITE_PATH'] = os.getenv('SQLITE_PATH', 'dados.db')
+# O sqlite3 guarda os comandos já compilados por conexão (LRU de cached_statements); o padrão (128)
+# é pequeno para as variações da listagem (forma do filtro x ordenação) somadas às demais consultas.
+app.config['SQLITE_CACHED_STATEMENTS'] = int(os.getenv('SQLITE_CACHED_STATEMENTS', 512))
+app.config['SQLITE_BUSY_TIMEOUT'] = float(os.getenv('SQLITE_BUSY_TIMEOUT', 30))                # segundos
+app.config['SQLITE_MMAP_SIZE'] = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))        # bytes
+app.config['SQLITE_CACHE_SIZE_KB'] = int(os.getenv('SQLITE_CACHE_SIZE_KB', 64 * 1024))
+app.config['SQLITE_LOTE_ESCRITA'] = int(os.getenv('SQLITE_LOTE_ESCRITA', 50))  # escritas por transação
+
+
+class ConexaoReutilizavel(sqlite3.Connection):
+    """close() só descarta a transação pendente: a conexão continua com a thread para o próximo request."""
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+
+def _abrir_conexao(**kwargs):
+    conn = sqlite3.connect(app.config['SQLITE_PATH'], timeout=app.config['SQLITE_BUSY_TIMEOUT'],
+                           cached_statements=app.config['SQLITE_CACHED_STATEMENTS'],
+                           factory=ConexaoReutilizavel, **kwargs)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f"PRAGMA mmap_size={app.config['SQLITE_MMAP_SIZE']}")
+    conn.execute(f"PRAGMA cache_size=-{app.config['SQLITE_CACHE_SIZE_KB']}")
+    global _migrado
+    if not _migrado:
+        with _migracao_lock:
+            if not _migrado:
+                _migrar(conn)
+                _migrado = True
+    return conn
+
+
+_migrado = False
+_migracao_lock = threading.Lock()
+
+
+def _migrar(conn):
+    """Bancos criados antes da coluna gerada mes (schema.sql): adiciona a coluna."""
+    tipos = {linha[1]: linha[2].upper() for linha in conn.execute('PRAGMA table_xinfo(recharges)')}
+    # Índice de uma versão anterior: o agrupamento por mês é feito sobre as linhas já lidas
+    conn.execute('DROP INDEX IF EXISTS idx_recharges_user_mes')
+    if tipos.get('mes') == 'TEXT':
+        # Versão anterior guardava 'YYYY-MM'; agora é o mesmo inteiro do Postgres
+        conn.execute('ALTER TABLE recharges DROP COLUMN mes')
+        del tipos['mes']
+    if 'mes' not in tipos:
+        conn.execute("ALTER TABLE recharges ADD COLUMN mes INTEGER GENERATED ALWAYS AS "
+                     "(CAST(strftime('%Y', data) AS INTEGER) * 12 + CAST(strftime('%m', data) AS INTEGER) - 1) VIRTUAL")
+    conn.commit()
+
+
+def rotulo_mes(mes):
+    """Converte o mês inteiro (ano * 12 + mês - 1) em 'YYYY-MM'."""
+    return f"{mes // 12:04d}-{mes % 12 + 1:02d}"
+
+
+_conexoes = threading.local()
+
+
+def conectar():
+    """Conexão de leitura da thread atual (aberta na primeira vez, depois reaproveitada)."""
+    conn = getattr(_conexoes, 'conn', None)
+    if conn is None:
+        conn = _conexoes.conn = _abrir_conexao()
+    return conn
+
+
+_fila_escrita = queue.Queue()
+_escritor = None
+_escritor_lock = threading.Lock()
+
+
+def _loop_escritor():
+    # Autocommit no driver: as transações são controladas aqui (BEGIN IMMEDIATE ... COMMIT)
+    conn = _abrir_conexao(isolation_level=None)
+    while True:
+        lote = [_fila_escrita.get()]
+        while len(lote) < app.config['SQLITE_LOTE_ESCRITA']:
+            try:
+                lote.append(_fila_escrita.get_nowait())
+            except queue.Empty:
+                break
+        concluidos = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for funcao, futuro in lote:
+                # Savepoint por escrita: uma que falha não desfaz as outras do lote
+                conn.execute('SAVEPOINT escrita')
+                try:
+                    concluidos.append((futuro, funcao(conn), None))
+                    conn.execute('RELEASE escrita')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO escrita')
+                    conn.execute('RELEASE escrita')
+                    concluidos.append((futuro, None, e))
+            conn.execute('COMMIT')
+        except Exception as e:
+            # Falha do próprio lote (ex.: busy timeout): nenhuma escrita foi gravada
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            concluidos = [(futuro, None, e) for _funcao, futuro in lote]
+        for futuro, resultado, erro in concluidos:
+            if erro is None:
+                futuro.set_result(resultado)
+            else:
+                futuro.set_exception(erro)
+
+
+def escrever(funcao):
+    """
+    Executa funcao(conn) na thread escritora, dentro de uma transação, e devolve o resultado
+    (ou relança a exceção). funcao não deve chamar commit/rollback.
+    """
+    global _escritor
+    if _escritor is None:
+        with _escritor_lock:
+            if _escritor is None:
+                _escritor = threading.Thread(target=_loop_escritor, name='sqlite-escritor', daemon=True)
+                _escritor.start()
+    futuro = Future()
+    _fila_escrita.put((funcao, futuro))
+    return futuro.result()
+
+
 # ----------------- MODELO DE USUÁRIO -----------------
 class User(UserMixin):
     def __init__(self, id, nome, email):
@@ -83,7 +228,7 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    conn = sqlite3.connect("dados.db")
+    conn = conectar()
     cursor = conn.cursor()
     cursor.execute("SELECT id, nome, email FROM users WHERE id=?", (user_id,))
     row = cursor.fetchone()
@@ -142,7 +287,7 @@ def has_complete_config(user_id: int) -> bool:
     Retorna True se o usuário possui preco_gasolina e consumo_km_l preenchidos,
     considerando consumo_km_l > 0. Caso contrário, retorna False.
     """
-    conn = sqlite3.connect("dados.db")
+    conn = conectar()
     cursor = conn.cursor()
     cursor.execute("""
         SELECT preco_gasolina, consumo_km_l
@@ -341,7 +486,7 @@ def login():
     if form.validate_on_submit():
         email = form.email.data
         senha = form.senha.data
-        conn = sqlite3.connect("dados.db")
+        conn = conectar()
         cursor = conn.cursor()
         cursor.execute("SELECT id, nome, email, senha_hash FROM users WHERE email=?", (email,))
         row = cursor.fetchone()
@@ -370,17 +515,13 @@ def register():
             nome = form.nome.data
             email = form.email.data
             senha_hash = generate_password_hash(form.senha.data)
-            conn = sqlite3.connect("dados.db")
-            cursor = conn.cursor()
             try:
-                cursor.execute("INSERT INTO users (nome, email, senha_hash) VALUES (?, ?, ?)", (nome, email, senha_hash))
-                conn.commit()
+                escrever(lambda conn: conn.execute("INSERT INTO users (nome, email, senha_hash) VALUES (?, ?, ?)",
+                                                   (nome, email, senha_hash)))
                 flash(_("Conta criada com sucesso! Faça login."), "success")
                 return redirect(url_for("index"))
             except sqlite3.IntegrityError:
                 flash(_("Email já cadastrado."), "danger")
-            finally:
-                conn.close()
         else:
             for field, errors in form.errors.items():
                 for err in errors:
@@ -407,14 +548,11 @@ def recharge():
             local = form.local.data
             observacoes = form.observacoes.data
             isento = 1 if form.isento.data else 0
-            conn = sqlite3.connect("dados.db")
-            cursor = conn.cursor()
-            cursor.execute("""
+            user_id = int(current_user.id)
+            escrever(lambda conn: conn.execute("""
                 INSERT INTO recharges (user_id, data, kwh, custo, isento, odometro, local, observacoes)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (int(current_user.id), data, kwh, custo, isento, odometro, local, observacoes))
-            conn.commit()
-            conn.close()
+            """, (user_id, data, kwh, custo, isento, odometro, local, observacoes)))
             flash(_("Recarga registrada com sucesso!"), "success")
             return redirect(url_for("dashboard"))
         else:
@@ -439,31 +577,35 @@ def bulk_recharge():
                 flash(msg, "danger")
             return redirect(url_for("bulk_recharge"))
 
-        # Inserção no banco
-        conn = sqlite3.connect("dados.db")
-        cursor = conn.cursor()
-        count_ok = 0
-        for r in rows:
-            try:
-                cursor.execute("""
-                    INSERT INTO recharges (user_id, data, kwh, custo, isento, odometro, local, observacoes)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    int(current_user.id),
-                    r['data'],
-                    r['kwh'],
-                    r['custo'],
-                    r['isento'],
-                    r['odometro'],
-                    r['local'],
-                    r['observacoes']
-                ))
-                count_ok += 1
-            except Exception as e:
-                flash(_(f"Falha ao inserir linha: {r}. Detalhes: {e}"), "warning")
-
-        conn.commit()
-        conn.close()
+        # Inserção no banco (na thread escritora; as falhas voltam para o flash aqui)
+        user_id = int(current_user.id)
+
+        def inserir(conn):
+            cursor = conn.cursor()
+            falhas = []
+            for r in rows:
+                try:
+                    cursor.execute("""
+                        INSERT INTO recharges (user_id, data, kwh, custo, isento, odometro, local, observacoes)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """, (
+                        user_id,
+                        r['data'],
+                        r['kwh'],
+                        r['custo'],
+                        r['isento'],
+                        r['odometro'],
+                        r['local'],
+                        r['observacoes']
+                    ))
+                except Exception as e:
+                    falhas.append((r, e))
+            return falhas
+
+        falhas = escrever(inserir)
+        for r, e in falhas:
+            flash(_(f"Falha ao inserir linha: {r}. Detalhes: {e}"), "warning")
+        count_ok = len(rows) - len(falhas)
 
         flash(_(f"Importação concluída. {count_ok} recarga(s) adicionada(s)."), "success")
         return redirect(url_for("dashboard"))
@@ -480,28 +622,24 @@ def bulk_recharge():
 @login_required
 def account():
     form = AccountForm()
-    conn = sqlite3.connect("dados.db")
-    cursor = conn.cursor()
     if request.method == "POST":
         if form.validate_on_submit():
             preco_gasolina = form.preco_gasolina.data
             consumo_km_l = form.consumo_km_l.data
-            cursor.execute("SELECT id FROM settings WHERE user_id=?", (int(current_user.id),))
-            row = cursor.fetchone()
-            if row:
-                cursor.execute("UPDATE settings SET preco_gasolina=?, consumo_km_l=? WHERE user_id=?",
-                               (preco_gasolina, consumo_km_l, int(current_user.id)))
-            else:
-                cursor.execute("INSERT INTO settings (user_id, preco_gasolina, consumo_km_l) VALUES (?, ?, ?)",
-                               (int(current_user.id), preco_gasolina, consumo_km_l))
-            conn.commit()
-            conn.close()
+            user_id = int(current_user.id)
+            escrever(lambda conn: conn.execute("""
+                INSERT INTO settings (user_id, preco_gasolina, consumo_km_l) VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE
+                    SET preco_gasolina = excluded.preco_gasolina, consumo_km_l = excluded.consumo_km_l
+            """, (user_id, preco_gasolina, consumo_km_l)))
             flash(_("Configurações atualizadas com sucesso!"), "success")
             return redirect(url_for("dashboard"))
         else:
             for field, errors in form.errors.items():
                 for err in errors:
                     flash(_(f"Erro em {field}: {err}"), "danger")
+    conn = conectar()
+    cursor = conn.cursor()
     cursor.execute("SELECT preco_gasolina, consumo_km_l FROM settings WHERE user_id=?", (int(current_user.id),))
     config = cursor.fetchone()
     conn.close()
@@ -516,7 +654,7 @@ def account():
 @login_required
 def api_recharges():
     user_id = int(current_user.id)
-    conn = sqlite3.connect("dados.db")
+    conn = conectar()
     cursor = conn.cursor()
     cursor.execute("SELECT data, kwh, custo, isento FROM recharges WHERE user_id=? ORDER BY data", (user_id,))
     rows = cursor.fetchall()
@@ -534,10 +672,10 @@ def api_recharges_monthly():
     user_id = int(current_user.id)
 
     # Buscar dados do usuário
-    conn = sqlite3.connect("dados.db")
+    conn = conectar()
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT data, kwh, custo, isento, odometro
+        SELECT mes, kwh, custo, isento, odometro
         FROM recharges
         WHERE user_id=?
         ORDER BY date(data), id
@@ -561,13 +699,8 @@ def api_recharges_monthly():
         "odometros": []
     })
 
-    # Processar linhas
-    for data, kwh, custo, isento, odometro in rows:
-        try:
-            mes = datetime.fromisoformat(data).strftime("%Y-%m")  # 'YYYY-MM'
-        except Exception:
-            mes = str(data)[:7]
-
+    # Processar linhas (mes, ano * 12 + mês - 1, já vem da coluna gerada)
+    for mes, kwh, custo, isento, odometro in rows:
         monthly[mes]["custo_total"] += float(custo or 0)
         monthly[mes]["kwh"] += float(kwh or 0)
         if odometro is not None:
@@ -592,7 +725,7 @@ def api_recharges_monthly():
     # Calcular economia, km e consumo/100km por mês
     for idx, mes in enumerate(meses_ord):
         data_mes = monthly[mes]
-        labels.append(mes)
+        labels.append(rotulo_mes(mes))
 
         # Custos
         ct = float(data_mes["custo_total"])
@@ -665,10 +798,10 @@ def dashboard():
     user_id = int(current_user.id)
 
     # Carregar dados
-    conn = sqlite3.connect("dados.db")
+    conn = conectar()
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT id, data, kwh, custo, isento, odometro, local, observacoes
+        SELECT id, data, kwh, custo, isento, odometro, local, observacoes, mes
         FROM recharges
         WHERE user_id=?
         ORDER BY date(data), id
@@ -739,13 +872,11 @@ def dashboard():
 
     # ===== Cálculo das tendências =====
     from collections import defaultdict
-    from datetime import datetime
 
     monthly = defaultdict(lambda: {"count_total": 0, "count_isentas": 0, "count_pagas": 0,
                                    "custo_total": 0, "custo_pagamento": 0, "kwh": 0, "odometros": []})
 
-    for (_id, data, kwh, custo, isento, odometro, *_rest) in recargas:
-        mes = datetime.fromisoformat(data).strftime("%Y-%m")
+    for (_id, data, kwh, custo, isento, odometro, _local, _observacoes, mes) in recargas:
         monthly[mes]["count_total"] += 1
         monthly[mes]["custo_total"] += float(custo or 0)
         monthly[mes]["kwh"] += float(kwh or 0)
@@ -863,13 +994,6 @@ def api_manage_recharges():
     sort_by = request.args.get('sort_by', 'data')
     sort_dir = request.args.get('sort_dir', 'asc')
 
-    # Filtros
-    local = request.args.get('local', '').strip()
-    observacoes = request.args.get('observacoes', '').strip()
-    isento = request.args.get('isento', 'all')
-    date_from = request.args.get('date_from')
-    date_to = request.args.get('date_to')
-
     # Validação sort_by
     valid_sort = ['data', 'kwh', 'custo', 'isento', 'odometro', 'local', 'observacoes']
     if sort_by not in valid_sort:
@@ -877,29 +1001,10 @@ def api_manage_recharges():
     sort_dir = 'desc' if sort_dir == 'desc' else 'asc'
 
     user_id = int(current_user.id)
-    conn = sqlite3.connect('dados.db')
+    conn = conectar()
     cursor = conn.cursor()
 
-    # Monta cláusula WHERE
-    where_clauses = ['user_id=?']
-    params = [user_id]
-    if local:
-        where_clauses.append('LOWER(local) LIKE ?')
-        params.append(f'%{local.lower()}%')
-    if observacoes:
-        where_clauses.append('LOWER(observacoes) LIKE ?')
-        params.append(f'%{observacoes.lower()}%')
-    if isento in ['true', 'false']:
-        where_clauses.append('isento=?')
-        params.append(1 if isento == 'true' else 0)
-    if date_from:
-        where_clauses.append('date(data) >= date(?)')
-        params.append(date_from)
-    if date_to:
-        where_clauses.append('date(data) <= date(?)')
-        params.append(date_to)
-
-    where_sql = ' AND '.join(where_clauses)
+    where_sql, params = where_filtros_recargas(user_id, request.args)
 
     # Conta total
     cursor.execute(f'SELECT COUNT(*) FROM recharges WHERE {where_sql}', params)
@@ -932,6 +1037,62 @@ def api_manage_recharges():
         'has_next': page * page_size < total
     })
 
+def where_filtros_recargas(user_id, filtros):
+    """WHERE (e parâmetros) dos filtros da listagem; usado pela listagem e pelo endpoint em lote."""
+    local = (filtros.get('local') or '').strip()
+    observacoes = (filtros.get('observacoes') or '').strip()
+    isento = filtros.get('isento', 'all')
+    date_from = filtros.get('date_from')
+    date_to = filtros.get('date_to')
+
+    where_clauses = ['user_id=?']
+    params = [user_id]
+    if local:
+        where_clauses.append('LOWER(local) LIKE ?')
+        params.append(f'%{local.lower()}%')
+    if observacoes:
+        where_clauses.append('LOWER(observacoes) LIKE ?')
+        params.append(f'%{observacoes.lower()}%')
+    if isento in ['true', 'false']:
+        where_clauses.append('isento=?')
+        params.append(1 if isento == 'true' else 0)
+    if date_from:
+        where_clauses.append('date(data) >= date(?)')
+        params.append(date_from)
+    if date_to:
+        where_clauses.append('date(data) <= date(?)')
+        params.append(date_to)
+    return ' AND '.join(where_clauses), params
+
+
+def filtros_do_json(filtros):
+    """
+    Valida o dict 'filters' do JSON (mesmas regras do FiltroRecargas do app.py) e devolve os valores
+    como viriam da query string, para where_filtros_recargas. Retorna (filtros, campo_invalido).
+    """
+    normalizados = {}
+    isento = filtros.get('isento')
+    if isinstance(isento, bool):
+        isento = 'true' if isento else 'false'
+    elif isento is None or isento == '':
+        isento = 'all'
+    if isento not in ('all', 'true', 'false'):
+        return None, 'isento'
+    normalizados['isento'] = isento
+    for campo in ('local', 'observacoes', 'date_from', 'date_to'):
+        valor = filtros.get(campo)
+        if valor is None:
+            continue
+        if not isinstance(valor, str):
+            return None, campo
+        if campo.startswith('date_') and valor:
+            try:
+                date.fromisoformat(valor)
+            except ValueError:
+                return None, campo
+        normalizados[campo] = valor
+    return normalizados, None
+
 # ========== ENDPOINT 2: PATCH /api/manage_recharges/<id> ==========
 @app.route('/api/manage_recharges/<int:recarga_id>', methods=['PATCH'])
 @login_required
@@ -963,29 +1124,19 @@ def api_update_recharge(recarga_id):
     if errors:
         return jsonify({'error': 'validation_failed', 'fields': errors}), 400
 
-    # Atualiza no banco
-    conn = sqlite3.connect('dados.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM recharges WHERE id=?', (recarga_id,))
-    row = cursor.fetchone()
-    if not row:
-        conn.close()
-        return jsonify({'error': 'not_found'}), 404
-    if row[0] != int(current_user.id):
-        conn.close()
-        return jsonify({'error': 'forbidden'}), 403
-
-    cursor.execute('''
-        UPDATE recharges SET data=?, kwh=?, custo=?, isento=?, odometro=?, local=?, observacoes=? WHERE id=?
-    ''', (
+    # Atualiza e devolve a linha num único comando (RETURNING: SQLite >= 3.35); dono verificado no WHERE
+    valores = (
         data['data'], kwh, custo, 1 if data.get('isento') else 0,
-        odometro, data.get('local', ''), data.get('observacoes', ''), recarga_id
-    ))
-    conn.commit()
-
-    cursor.execute('SELECT id, data, kwh, custo, isento, odometro, local, observacoes FROM recharges WHERE id=?', (recarga_id,))
-    r = cursor.fetchone()
-    conn.close()
+        odometro, data.get('local', ''), data.get('observacoes', ''), recarga_id, int(current_user.id)
+    )
+    r = escrever(lambda conn: conn.execute('''
+        UPDATE recharges SET data=?, kwh=?, custo=?, isento=?, odometro=?, local=?, observacoes=?
+        WHERE id=? AND user_id=?
+        RETURNING id, data, kwh, custo, isento, odometro, local, observacoes
+    ''', valores).fetchall())  # fetchall: o RETURNING precisa terminar antes do commit
+    if not r:
+        return _erro_recarga_nao_alterada(recarga_id)
+    r = r[0]
 
     return jsonify({'updated': True, 'item': {
         'id': r[0], 'data': r[1], 'kwh': r[2], 'custo': r[3],
@@ -997,21 +1148,122 @@ def api_update_recharge(recarga_id):
 @login_required
 @csrf.exempt
 def api_delete_recharge(recarga_id):
-    conn = sqlite3.connect('dados.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM recharges WHERE id=?', (recarga_id,))
-    row = cursor.fetchone()
-    if not row:
-        conn.close()
-        return jsonify({'error': 'not_found'}), 404
-    if row[0] != int(current_user.id):
-        conn.close()
-        return jsonify({'error': 'forbidden'}), 403
+    user_id = int(current_user.id)
+    if not escrever(lambda conn: conn.execute('DELETE FROM recharges WHERE id=? AND user_id=? RETURNING id',
+                                              (recarga_id, user_id)).fetchall()):
+        return _erro_recarga_nao_alterada(recarga_id)
+    return jsonify({'deleted': True})
 
-    cursor.execute('DELETE FROM recharges WHERE id=?', (recarga_id,))
-    conn.commit()
+
+def _erro_recarga_nao_alterada(recarga_id):
+    """Nada foi alterado: distingue recarga inexistente (404) de recarga de outro usuário (403)."""
+    conn = conectar()
+    existe = conn.execute('SELECT 1 FROM recharges WHERE id=?', (recarga_id,)).fetchone()
     conn.close()
-    return jsonify({'deleted': True})
+    if existe:
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify({'error': 'not_found'}), 404
+
+
+# ========== ENDPOINT 4: POST /api/manage_recharges/bulk ==========
+app.config['BULK_MAX_IDS'] = int(os.getenv('BULK_MAX_IDS', 5000))
+CAMPOS_EDITAVEIS = ('data', 'kwh', 'custo', 'isento', 'odometro', 'local', 'observacoes')
+
+
+def _validar_campos_lote(campos):
+    """Valida um subconjunto dos campos editáveis com as mesmas regras do PATCH; retorna (valores, erros)."""
+    valores, errors = {}, {}
+    for f, valor in campos.items():
+        if f in ('data', 'kwh', 'custo', 'odometro') and (valor is None or str(valor).strip() == ''):
+            errors[f] = _('Campo obrigatório')
+        elif f in ('kwh', 'custo', 'odometro'):
+            valores[f] = float(valor)  # ValueError/TypeError tratados pelo chamador
+        elif f == 'isento':
+            # Só booleanos do JSON: bool("false") seria True
+            if isinstance(valor, bool):
+                valores[f] = 1 if valor else 0
+            else:
+                errors[f] = _('Valor inválido')
+        elif f == 'data':
+            if isinstance(valor, str):
+                valores[f] = valor
+            else:
+                errors[f] = _('Valor inválido')
+        else:
+            valores[f] = str(valor or '')
+    if valores.get('kwh', 1) <= 0: errors['kwh'] = _('Deve ser > 0')
+    if valores.get('custo', 0) < 0: errors['custo'] = _('Não pode ser negativo')
+    if valores.get('odometro', 1) <= 0: errors['odometro'] = _('Deve ser > 0')
+    return valores, errors
+
+
+@app.route('/api/manage_recharges/bulk', methods=['POST'])
+@login_required
+@csrf.exempt
+def api_bulk_recharges():
+    """
+    Exclui, marca como isentas ou altera várias recargas num único comando (mesmo contrato do app.py).
+    Payload: {"action": "delete" | "set_isento" | "update",
+              "ids": [...] ou "filters": {local, observacoes, isento, date_from, date_to},
+              "isento": true/false (set_isento), "fields": {...} (update)}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'invalid_payload'}), 400
+    action = data.get('action')
+    if action not in ('delete', 'set_isento', 'update'):
+        return jsonify({'error': 'invalid_action'}), 400
+
+    # Alvo: lista de ids (json_each evita montar um IN com milhares de ?) ou os filtros da listagem
+    user_id = int(current_user.id)
+    if 'ids' in data:
+        ids = data['ids']
+        if not isinstance(ids, list) or not ids or len(ids) > app.config['BULK_MAX_IDS']:
+            return jsonify({'error': 'invalid_ids'}), 400
+        try:
+            ids = [int(i) for i in ids]
+        except (TypeError, ValueError):
+            return jsonify({'error': 'invalid_ids'}), 400
+        where_sql, params = 'user_id=? AND id IN (SELECT value FROM json_each(?))', [user_id, json.dumps(ids)]
+    elif isinstance(data.get('filters'), dict):
+        # Valida antes de montar o SQL: filtro ignorado em silêncio ampliaria o lote
+        filtros, campo_invalido = filtros_do_json(data['filters'])
+        if campo_invalido:
+            return jsonify({'error': 'invalid_filter', 'field': campo_invalido}), 400
+        where_sql, params = where_filtros_recargas(user_id, filtros)
+        if len(params) == 1:
+            # Sem nenhum filtro o lote pegaria todas as recargas do usuário
+            return jsonify({'error': 'empty_filters'}), 400
+    else:
+        return jsonify({'error': 'missing_target'}), 400
+
+    if action == 'set_isento':
+        if not isinstance(data.get('isento', True), bool):
+            return jsonify({'error': 'invalid_payload'}), 400
+        valores = {'isento': 1 if data.get('isento', True) else 0}
+    elif action == 'update':
+        campos = data.get('fields')
+        if not isinstance(campos, dict) or not campos:
+            return jsonify({'error': 'invalid_payload'}), 400
+        desconhecidos = sorted(set(campos) - set(CAMPOS_EDITAVEIS))
+        if desconhecidos:
+            return jsonify({'error': 'unknown_fields', 'fields': desconhecidos}), 400
+        try:
+            valores, errors = _validar_campos_lote(campos)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'invalid_number_format'}), 400
+        if errors:
+            return jsonify({'error': 'validation_failed', 'fields': errors}), 400
+
+    if action == 'delete':
+        sql = f'DELETE FROM recharges WHERE {where_sql} RETURNING id'
+    else:
+        set_sql = ', '.join(f'{campo}=?' for campo in valores)
+        sql = f'UPDATE recharges SET {set_sql} WHERE {where_sql} RETURNING id'
+        params = list(valores.values()) + params
+    afetados = [r[0] for r in escrever(lambda conn: conn.execute(sql, params).fetchall())]
+
+    return jsonify({'action': action, 'affected': len(afetados), 'ids': afetados})
 
 
 
@@ -1027,7 +1279,7 @@ def export_recharges():
     date_to = request.args.get('date_to')
 
     user_id = int(current_user.id)
-    conn = sqlite3.connect('dados.db')
+    conn = conectar()
     cursor = conn.cursor()
 
     # WHERE
@@ -1133,19 +1385,13 @@ def contact():
         '''
         
         # Log no SQLite
-        conn = sqlite3.connect('dados.db')
-        cursor = conn.cursor()
-        
         # --- Usar isoformat() para o tipo TIMESTAMP no SQLITE ---
         data_envio = datetime.now().isoformat() 
 
-        cursor.execute('''
+        escrever(lambda conn: conn.execute('''
             INSERT INTO contact_logs (nome, email, mensagem, data_envio, status)
             VALUES (?, ?, ?, ?, ?)
-        ''', (nome, email, mensagem, data_envio, status))
-        
-        conn.commit()
-        conn.close()
+        ''', (nome, email, mensagem, data_envio, status)))
 
         # Simula envio bem-sucedido
         flash(_('Mensagem enviada com sucesso!'))
@@ -0,0 +1,348 @@
+"""
+Assets estáticos e textos do JavaScript por idioma, compartilhados por app.py e app_sqlite3.py
+(os templates são os mesmos nas duas versões). Cada app chama init_app(app).
+"""
+from flask import Flask, current_app, request, url_for, Response
+from flask_babel import get_locale
+import click
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+
+# Minificadores opcionais para o build de assets: sem eles os arquivos são só concatenados
+try:
+    import rcssmin
+    import rjsmin
+except ImportError:
+    rcssmin = rjsmin = None
+
+
+# ----------------- ASSETS ESTÁTICOS (bundles com fingerprint) -----------------
+# Bibliotecas de terceiros em versões fixas: caminho em static/ -> URL de origem.
+# 'flask --app app assets-vendor' baixa para static/vendor/ (pasta versionada no git);
+# a URL de origem só aparece nas páginas em desenvolvimento, sem build e sem a cópia local.
+VENDOR_ASSETS = {
+    'vendor/bootswatch-5.3.2/lux/bootstrap.min.css':
+        'https://cdn.jsdelivr.net/npm/bootswatch@5.3.2/dist/lux/bootstrap.min.css',
+    'vendor/bootstrap-5.3.2/bootstrap.bundle.min.js':
+        'https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/js/bootstrap.bundle.min.js',
+    'vendor/chartjs-4.4.1/chart.umd.min.js':
+        'https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.min.js',
+    'vendor/fontawesome-6.4.2/css/all.min.css':
+        'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.2/css/all.min.css',
+}
+# Fontes referenciadas pelo all.min.css (../webfonts/)
+VENDOR_ASSETS.update({
+    f'vendor/fontawesome-6.4.2/webfonts/{fonte}.{ext}':
+        f'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.2/webfonts/{fonte}.{ext}'
+    for fonte in ('fa-brands-400', 'fa-regular-400', 'fa-solid-900', 'fa-v4compatibility')
+    for ext in ('woff2', 'ttf')
+})
+# Nunito Sans, que o tema Lux importa do Google Fonts (usada por static/fonts.css)
+VENDOR_ASSETS.update({
+    f'vendor/nunito-sans-5/nunito-sans-latin-{peso}-normal.woff2':
+        f'https://cdn.jsdelivr.net/npm/@fontsource/nunito-sans@5/files/nunito-sans-latin-{peso}-normal.woff2'
+    for peso in (400, 600)
+})
+
+# Bundles usados pelas páginas: nome lógico -> arquivos de static/, na ordem de concatenação
+ASSET_BUNDLES = {
+    'app.css': ['fonts.css',
+                'vendor/bootswatch-5.3.2/lux/bootstrap.min.css',
+                'vendor/fontawesome-6.4.2/css/all.min.css',
+                'styles.css'],
+    'app.js': ['vendor/bootstrap-5.3.2/bootstrap.bundle.min.js'],
+    'charts.js': ['vendor/chartjs-4.4.1/chart.umd.min.js'],
+    'dashboard_charts.js': ['dashboard_charts.js'],
+    'manage_recharges.js': ['manage_recharges.js'],
+}
+# Arquivos que só fazem sentido com a cópia local das bibliotecas (sem ela, o tema usa o Google Fonts)
+ASSET_REQUER_VENDOR = {
+    'fonts.css': [nome for nome in VENDOR_ASSETS if nome.startswith('vendor/nunito-sans-5/')],
+}
+# Arquivos avulsos que também recebem fingerprint (imagens, favicons)
+ASSET_ARQUIVOS = ['img']
+
+# Saída do build: static/dist/ + manifest.json (nome lógico -> arquivo com hash)
+ASSETS_DIST = 'dist'
+ASSETS_MAX_AGE = 365 * 24 * 3600
+
+_CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+# @import de folhas externas (ex.: Google Fonts no tema): removido no build, a fonte vem de fonts.css
+_CSS_IMPORT_EXTERNO = re.compile(r"""@import\s+url\(\s*['"]?(?:https?:)?//[^)]*\)[^;]*;""")
+
+
+def _gravar_com_fingerprint(nome, conteudo):
+    """Grava em static/dist/ como <nome>.<hash>.<ext> e devolve o caminho relativo a static/."""
+    base, ext = os.path.splitext(nome)
+    destino = f"{ASSETS_DIST}/{base}.{hashlib.sha256(conteudo).hexdigest()[:12]}{ext}"
+    caminho = os.path.join(current_app.static_folder, destino)
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    with open(caminho, 'wb') as f:
+        f.write(conteudo)
+    return destino
+
+
+def _copiar_com_fingerprint(nome, manifest):
+    if nome not in manifest:
+        with open(os.path.join(current_app.static_folder, nome), 'rb') as f:
+            manifest[nome] = _gravar_com_fingerprint(nome, f.read())
+    return manifest[nome]
+
+
+def _reescrever_urls_css(css, origem, manifest):
+    """Aponta os url(...) relativos do CSS para cópias com fingerprint (fontes, imagens)."""
+    pasta = posixpath.dirname(origem)
+
+    def trocar(m):
+        ref = m.group(2).strip()
+        if ref.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+            return m.group(0)
+        caminho, sufixo = re.match(r'([^?#]*)(.*)', ref).groups()
+        alvo = _copiar_com_fingerprint(posixpath.normpath(posixpath.join(pasta, caminho)), manifest)
+        # O CSS do bundle fica em static/dist/: referência relativa a essa pasta
+        return f'url({posixpath.relpath(alvo, ASSETS_DIST)}{sufixo})'
+
+    return _CSS_URL.sub(trocar, css)
+
+
+def construir_assets():
+    """Concatena, minifica e aplica fingerprint em ASSET_BUNDLES e ASSET_ARQUIVOS."""
+    static = current_app.static_folder
+    shutil.rmtree(os.path.join(static, ASSETS_DIST), ignore_errors=True)
+    manifest = {}
+
+    for pasta in ASSET_ARQUIVOS:
+        for raiz, _dirs, arquivos in os.walk(os.path.join(static, pasta)):
+            for arquivo in sorted(a for a in arquivos if not a.startswith('.')):
+                nome = os.path.relpath(os.path.join(raiz, arquivo), static).replace(os.sep, '/')
+                _copiar_com_fingerprint(nome, manifest)
+
+    for bundle, arquivos in ASSET_BUNDLES.items():
+        partes = []
+        for nome in arquivos:
+            with open(os.path.join(static, nome), encoding='utf-8') as f:
+                conteudo = f.read()
+            ja_minificado = '.min.' in nome
+            if bundle.endswith('.css'):
+                conteudo = _CSS_IMPORT_EXTERNO.sub('', conteudo)
+                conteudo = _reescrever_urls_css(conteudo, nome, manifest)
+                if rcssmin and not ja_minificado:
+                    conteudo = rcssmin.cssmin(conteudo)
+            elif rjsmin and not ja_minificado:
+                conteudo = rjsmin.jsmin(conteudo)
+            partes.append(conteudo)
+        # ';' entre scripts evita que um arquivo sem ';' final "cole" no próximo
+        separador = '\n' if bundle.endswith('.css') else '\n;\n'
+        manifest[bundle] = _gravar_com_fingerprint(bundle, separador.join(partes).encode('utf-8'))
+
+    for idioma in current_app.config['LANGUAGES']:
+        manifest[f'i18n/{idioma}.js'] = _gravar_com_fingerprint(f'i18n/{idioma}.js', bundle_i18n(idioma)[0])
+
+    with open(os.path.join(static, ASSETS_DIST, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+
+_assets_manifest = None
+
+
+def _manifest_assets():
+    """Manifest do último build (relido a cada request em modo debug)."""
+    global _assets_manifest
+    if _assets_manifest is None or current_app.debug:
+        try:
+            with open(os.path.join(current_app.static_folder, ASSETS_DIST, 'manifest.json'), encoding='utf-8') as f:
+                _assets_manifest = json.load(f)
+        except FileNotFoundError:
+            _assets_manifest = {}
+    return _assets_manifest
+
+
+def asset_url(nome):
+    """URL de um arquivo de static/: versão com fingerprint quando houver build."""
+    return url_for('static', filename=_manifest_assets().get(nome, nome))
+
+
+def asset_urls(bundle):
+    """
+    URLs de um bundle para <link>/<script>: um único arquivo com fingerprint quando há build;
+    sem build (desenvolvimento), os arquivos individuais, da cópia local ou da origem.
+    """
+    manifest = _manifest_assets()
+    if bundle in manifest:
+        return [url_for('static', filename=manifest[bundle])]
+    def local(nome):
+        return os.path.exists(os.path.join(current_app.static_folder, nome))
+
+    urls = []
+    for nome in ASSET_BUNDLES[bundle]:
+        if not all(local(dep) for dep in ASSET_REQUER_VENDOR.get(nome, ())):
+            continue
+        if nome in VENDOR_ASSETS and not local(nome) and not manifest:
+            urls.append(VENDOR_ASSETS[nome])
+        else:
+            urls.append(url_for('static', filename=nome))
+    return urls
+
+
+def _max_age_static(app):
+    def max_age(filename):
+        # Arquivos com fingerprint nunca mudam de conteúdo: cache de 1 ano
+        if filename and filename.replace(os.sep, '/').startswith(ASSETS_DIST + '/'):
+            return ASSETS_MAX_AGE
+        return Flask.get_send_file_max_age(app, filename)
+    return max_age
+
+
+def cache_assets_imutaveis(response):
+    """Marca os assets com fingerprint como immutable (o navegador nem revalida)."""
+    if (request.endpoint == 'static' and response.status_code == 200
+            and request.view_args.get('filename', '').startswith(ASSETS_DIST + '/')):
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+
+def assets_vendor_command():
+    """Baixa as bibliotecas de VENDOR_ASSETS para static/vendor/."""
+    import urllib.request
+    for nome, url in VENDOR_ASSETS.items():
+        caminho = os.path.join(current_app.static_folder, nome)
+        if os.path.exists(caminho):
+            continue
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        with urllib.request.urlopen(url, timeout=30) as resp, open(caminho, 'wb') as f:
+            shutil.copyfileobj(resp, f)
+        click.echo(f"{nome} <- {url}")
+
+
+def assets_build_command():
+    """Gera static/dist/ (bundles minificados com fingerprint + manifest.json)."""
+    faltando = [nome for nome in VENDOR_ASSETS
+                if not os.path.exists(os.path.join(current_app.static_folder, nome))]
+    if faltando:
+        # O Procfile sobe o gunicorn mesmo com o build falhando: o aviso fica no log do deploy
+        click.secho("AVISO: bibliotecas ausentes em static/vendor/, build de assets NÃO gerado. "
+                    "As páginas vão carregá-las das URLs de origem (CDN). Rode "
+                    "'flask --app app assets-vendor' numa máquina com internet e versione static/vendor/.",
+                    fg='red', bold=True, err=True)
+        for nome in faltando:
+            click.echo(f"  faltando: {nome}", err=True)
+        raise SystemExit(1)
+    for nome, destino in sorted(construir_assets().items()):
+        click.echo(f"{nome} -> {destino}")
+
+
+# ----------------- TEXTOS DO JAVASCRIPT POR IDIOMA -----------------
+def N_(texto):
+    """Marca o texto para o pybabel extract sem traduzir (a tradução vai no bundle i18n)."""
+    return texto
+
+
+# Constantes globais usadas pelos scripts das páginas -> msgid do messages.po
+JS_MENSAGENS = {
+    # Gerais (moeda e localidade)
+    'CurrencySymbolBRL': N_('R$'),
+    'LocaleCodePtBR': N_('pt-BR'),
+    # Dashboard: status e mensagens de erro
+    'LoadMonthlyDataErrorMessage': N_('Falha ao carregar dados mensais:'),
+    'LoadDataUnavailableMessage': N_('Não foi possível carregar os dados.'),
+    'NoDataToDisplayMessage': N_('Sem dados para exibir.'),
+    # Dashboard: rótulos dos gráficos
+    'LabelTotalCostBRL': N_('Custo Total (R$)'),
+    'LabelPaidRechargesBRL': N_('Recargas Pagas (R$)'),
+    'LabelPercentPaidOverTotal': N_('% Pagas sobre Total'),
+    'LabelKWhInMonth': N_('kWh no mês'),
+    'LabelConsumptionPer100Km': N_('Consumo / 100Km'),
+    'LabelKWh': N_('kWh'),
+    'LabelKWhPer100Km': N_('kWh / 100Km'),
+    'LabelKmInMonth': N_('Km no mês'),
+    'LabelKm': N_('Km'),
+    'LabelTotalSavingsBRL': N_('Economia Total (R$)'),
+    'LabelPaidSavingsBRL': N_('Economia (Pagas) (R$)'),
+    # Histórico de recargas
+    'YesMessage': N_('Sim'),
+    'NoMessage': N_('Não'),
+    'AllMessage': N_('Todos'),
+    'ErrorLoadingRecharges': N_('Erro ao carregar recargas.'),
+    'NoRechargesFound': N_('Nenhuma recarga encontrada.'),
+    'ErrorSaveMessage': N_('Erro ao salvar edição.'),
+    'RechargeUpdatedSuccess': N_('Recarga atualizada com sucesso!'),
+    'ErrorDeleteMessage': N_('Erro ao excluir recarga.'),
+    'RechargeDeletedSuccess': N_('Recarga excluída com sucesso!'),
+    'BulkDoneMessage': N_('Recargas alteradas:'),
+    'ErrorBulkMessage': N_('Erro ao aplicar a ação em lote.'),
+    'EditText': N_('Editar'),
+    'DeleteText': N_('Excluir'),
+    'DisplayingText': N_('Exibindo'),
+    'OfText': N_('de'),
+}
+
+_bundles_i18n = {}
+
+
+def bundle_i18n(idioma):
+    """
+    Script com as constantes de JS_MENSAGENS traduzidas a partir de
+    translations/<idioma>/LC_MESSAGES/messages.po. Retorna (conteúdo, hash curto).
+    """
+    if idioma not in _bundles_i18n or current_app.debug:
+        from babel.messages.pofile import read_po
+        caminho = os.path.join(current_app.root_path, current_app.config['BABEL_TRANSLATION_DIRECTORIES'],
+                               idioma, 'LC_MESSAGES', 'messages.po')
+        traducoes = {}
+        with open(caminho, 'rb') as f:
+            for msg in read_po(f):
+                # Mesma regra do gettext: entradas fuzzy ou vazias caem no msgid
+                if msg.id and msg.string and not msg.fuzzy:
+                    traducoes[msg.id] = msg.string
+        linhas = [f'// Gerado de translations/{idioma}/LC_MESSAGES/messages.po (não editar)']
+        linhas += [f'const {nome} = {json.dumps(traducoes.get(msgid, msgid), ensure_ascii=False)};'
+                   for nome, msgid in JS_MENSAGENS.items()]
+        conteudo = ('\n'.join(linhas) + '\n').encode('utf-8')
+        _bundles_i18n[idioma] = (conteudo, hashlib.sha256(conteudo).hexdigest()[:12])
+    return _bundles_i18n[idioma]
+
+
+def _idioma_js():
+    # Mesmo idioma escolhido pelo locale_selector do Babel de cada app
+    locale = get_locale()
+    idioma = str(locale) if locale else None
+    return idioma if idioma in current_app.config['LANGUAGES'] else current_app.config['BABEL_DEFAULT_LOCALE']
+
+
+def i18n_url():
+    """URL do bundle de textos do idioma atual: arquivo do build ou a rota abaixo, ambos com hash."""
+    idioma = _idioma_js()
+    destino = _manifest_assets().get(f'i18n/{idioma}.js')
+    if destino:
+        return url_for('static', filename=destino)
+    return url_for('i18n_bundle', idioma=idioma, v=bundle_i18n(idioma)[1])
+
+
+def i18n_bundle(idioma):
+    if idioma not in current_app.config['LANGUAGES']:
+        return Response(status=404)
+    conteudo, versao = bundle_i18n(idioma)
+    resposta = Response(conteudo, mimetype='text/javascript')
+    if request.args.get('v') == versao:
+        # URL com a versão do conteúdo: pode ficar em cache indefinidamente
+        resposta.cache_control.public = True
+        resposta.cache_control.max_age = ASSETS_MAX_AGE
+        resposta.cache_control.immutable = True
+    return resposta
+
+
+# ----------------- REGISTRO NO APP -----------------
+def init_app(app):
+    """Globais dos templates, rota do bundle i18n, cache dos assets e comandos assets-*."""
+    app.jinja_env.globals.update(asset_url=asset_url, asset_urls=asset_urls, i18n_url=i18n_url)
+    app.add_url_rule('/i18n/<idioma>.js', view_func=i18n_bundle)
+    app.get_send_file_max_age = _max_age_static(app)
+    app.after_request(cache_assets_imutaveis)
+    app.cli.command('assets-vendor')(assets_vendor_command)
+    app.cli.command('assets-build')(assets_build_command)
@@ -0,0 +1,226 @@
+"""
+Micro-benchmarks do EVChargeLog.com.
+
+Uso:
+    python benchmarks.py serializacao [--repeticoes N]
+    python benchmarks.py kpis [--repeticoes N]
+    python benchmarks.py brl [--repeticoes N]
+    python benchmarks.py senhas [--repeticoes N]
+    python benchmarks.py listagem [--repeticoes N]
+
+Os dados são sintéticos e imitam o formato real das respostas. Só o cenário listagem usa banco
+(DATABASE_URL), numa tabela temporária: os dados reais não são lidos nem alterados.
+"""
+import argparse
+import os
+import random
+import timeit
+from datetime import datetime, timedelta
+
+import psycopg2
+from flask import g
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from app import (app, FastJSONProvider, orjson, np, carregar_colunas, calcular_totais,
+                 agregar_por_mes, km_por_mes, calcular_serie_mensal, brl, FiltroRecargas,
+                 compilar_filtro, sql_total_recargas, sql_pagina_recargas, sql_pagina_com_total,
+                 _total_em_separado)
+
+
+# ----------------- DADOS SINTÉTICOS -----------------
+def gerar_payload_mensal(meses):
+    """Mesmo formato de /api/recharges/monthly (listas colunares de floats)."""
+    rnd = random.Random(42)
+    labels = [f"{2000 + m // 12}-{m % 12 + 1:02d}" for m in range(meses)]
+
+    def serie():
+        return [round(rnd.uniform(0, 1500), 2) for _ in range(meses)]
+
+    return {
+        "labels": labels,
+        "custos": {"total": serie(), "pagas": serie(), "percentual": serie()},
+        "consumo": serie(),
+        "km": serie(),
+        "economia": {"total": serie(), "pagas": serie()},
+        "consumo_por_100km": serie(),
+    }
+
+
+def gerar_payload_manage(itens):
+    """Mesmo formato de /api/manage_recharges (um dict por linha, datas do psycopg2)."""
+    rnd = random.Random(42)
+    inicio = datetime(2023, 1, 1)
+    items = [{
+        'id': i,
+        'data': inicio + timedelta(days=i),
+        'kwh': round(rnd.uniform(5, 70), 2),
+        'custo': round(rnd.uniform(0, 150), 2),
+        'isento': rnd.random() < 0.5,
+        'odometro': float(1000 + i * 35),
+        'local': 'Posto São Gualter',
+        'observacoes': 'Recarga rápida',
+    } for i in range(itens)]
+    return {'items': items, 'page': 1, 'page_size': itens, 'total': itens,
+            'has_prev': False, 'has_next': False}
+
+
+def gerar_linhas_recargas(qtd):
+    """Mesmo formato de SQL_COLUNAS_RECARGAS: (mes, kwh, custo, isento, odometro), 20 anos."""
+    rnd = random.Random(42)
+    mes_inicial = 2005 * 12
+    odometro = 1000.0
+    linhas = []
+    for i in range(qtd):
+        odometro += rnd.uniform(50, 400)
+        linhas.append((mes_inicial + i * 240 // qtd,
+                       round(rnd.uniform(5, 70), 2), round(rnd.uniform(0, 150), 2),
+                       rnd.random() < 0.5, round(odometro, 1)))
+    return linhas
+
+
+# ----------------- SERIALIZAÇÃO -----------------
+def bench_serializacao(repeticoes):
+    # "antes": provider padrão do Flask (json da stdlib, chaves ordenadas)
+    # "depois": FastJSONProvider (orjson quando instalado)
+    providers = [("stdlib (antes)", DefaultJSONProvider(app)),
+                 ("FastJSONProvider (depois)", FastJSONProvider(app))]
+    cenarios = [
+        ("monthly 120 meses", gerar_payload_mensal(120)),
+        ("monthly 1200 meses", gerar_payload_mensal(1200)),
+        ("manage página 20", gerar_payload_manage(20)),
+        ("manage 1000 itens", gerar_payload_manage(1000)),
+    ]
+
+    print(f"orjson instalado: {'sim' if orjson else 'não'}")
+    with app.app_context():
+        for nome, payload in cenarios:
+            print(f"\n{nome}")
+            for rotulo, provider in providers:
+                t = timeit.timeit(lambda: provider.response(payload), number=repeticoes)
+                print(f"  {rotulo:<28} {t / repeticoes * 1e6:10.1f} µs/resposta")
+
+
+# ----------------- KPIs -----------------
+def bench_kpis(repeticoes):
+    # "antes": motor em Python puro; "depois": motor NumPy (quando instalado)
+    motores = ["python"] + (["auto"] if np is not None else [])
+    print(f"NumPy instalado: {'sim' if np is not None else 'não'}")
+
+    def kpis_do_dashboard(linhas):
+        cols = carregar_colunas(linhas)
+        calcular_totais(cols)
+        km_por_mes(agregar_por_mes(cols, so_odometros_positivos=True), "dashboard")
+
+    def serie_mensal(linhas):
+        calcular_serie_mensal(carregar_colunas(linhas), 6.0, 10.0)
+
+    for qtd in (100_000, 500_000):
+        linhas = gerar_linhas_recargas(qtd)
+        for nome, funcao in (("dashboard", kpis_do_dashboard), ("monthly", serie_mensal)):
+            print(f"\n{nome} {qtd} recargas")
+            for motor in motores:
+                app.config['KPI_ENGINE'] = motor
+                t = timeit.timeit(lambda: funcao(linhas), number=repeticoes)
+                rotulo = "Python puro (antes)" if motor == "python" else "NumPy (depois)"
+                print(f"  {rotulo:<28} {t / repeticoes * 1e3:10.1f} ms/chamada")
+
+
+# ----------------- FILTRO brl -----------------
+def bench_brl(repeticoes):
+    # Um render do dashboard aplica o filtro em ~20 KPIs
+    valores = [random.Random(i).uniform(0, 20000) for i in range(20)]
+
+    def render(resolver_sempre):
+        for v in valores:
+            if resolver_sempre:
+                # "antes": idioma resolvido de novo a cada chamada
+                g.pop('_formato_numero', None)
+            brl(v)
+
+    for idioma in ("pt_BR", "en"):
+        print(f"\n20 valores, idioma {idioma}")
+        with app.test_request_context(f"/dashboard?lang={idioma}", headers={"Accept-Language": "es,en;q=0.8"}):
+            app.preprocess_request()
+            for rotulo, resolver_sempre in (("resolve a cada chamada (antes)", True),
+                                            ("cache em g (depois)", False)):
+                t = timeit.timeit(lambda: render(resolver_sempre), number=repeticoes)
+                print(f"  {rotulo:<32} {t / repeticoes * 1e6:10.1f} µs/render")
+
+
+# ----------------- HASH DE SENHAS -----------------
+def bench_senhas(repeticoes):
+    # Custo de CPU de um login (check_password_hash) para algumas políticas de PASSWORD_HASH_METHOD
+    metodos = ["scrypt", "scrypt:16384:8:1", "pbkdf2:sha256:600000", "pbkdf2:sha256:260000"]
+    for metodo in metodos:
+        senha_hash = generate_password_hash("segredo123", method=metodo)
+        t = timeit.timeit(lambda: check_password_hash(senha_hash, "segredo123"), number=repeticoes)
+        print(f"  {senha_hash.split('$', 1)[0]:<28} {t / repeticoes * 1e3:8.1f} ms/verificação")
+
+
+# ----------------- LISTAGEM: TOTAL POR JANELA x DUAS CONSULTAS -----------------
+def bench_listagem(repeticoes, linhas=100_000):
+    # Tabela temporária "recharges": pg_temp vem antes de public na busca, então o SQL do app
+    # (mesmo texto gerado pelo compilador de filtros) lê dela. Ids explícitos: nenhuma sequence é usada.
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cursor = conn.cursor()
+    cursor.execute("CREATE TEMP TABLE recharges (LIKE public.recharges INCLUDING INDEXES)")
+    cursor.execute("""
+        INSERT INTO recharges (id, user_id, data, kwh, custo, isento, odometro, local, observacoes)
+        SELECT i, 1, TIMESTAMP '2005-01-01' + i * INTERVAL '90 minutes', 5 + i %% 65, i %% 150,
+               i %% 2 = 0, 1000 + i * 3, 'Posto ' || i %% 100,
+               CASE WHEN i %% 1000 = 0 THEN 'raro' ELSE 'normal' END
+        FROM generate_series(1, %s) i
+    """, (linhas,))
+    cursor.execute("ANALYZE recharges")
+
+    cenarios = [
+        ("sem filtro (100%)", {}),
+        ("isento (50%)", {"isento": "true"}),
+        ("local 'posto 1' (11%)", {"local": "posto 1"}),
+        ("local 'posto 42' (1%)", {"local": "posto 42"}),
+        ("observações 'raro' (0,1%)", {"observacoes": "raro"}),
+        ("1 mês de datas (~0,4%)", {"date_from": "2010-03-01", "date_to": "2010-03-31"}),
+    ]
+    print(f"{linhas} recargas de um usuário, página 1 com 20 itens")
+    for sort_by in ("data", "custo"):
+        for nome, parametros in cenarios:
+            filtro = FiltroRecargas.de_parametros(parametros)
+            _, params = compilar_filtro(1, filtro)
+
+            def separado():
+                cursor.execute(sql_total_recargas(filtro.forma), params)
+                cursor.fetchone()
+                cursor.execute(sql_pagina_recargas(filtro.forma, sort_by, "asc"), params + [20, 0])
+                cursor.fetchall()
+
+            def janela():
+                cursor.execute(sql_pagina_com_total(filtro.forma, sort_by, "asc"), params + [20, 0])
+                cursor.fetchall()
+
+            with app.app_context():
+                app.config['MANAGE_TOTAL'] = 'auto'
+                escolha = "separado" if _total_em_separado(filtro) else "janela"
+            print(f"\nordenado por {sort_by}, {nome} -> auto usa {escolha}")
+            for rotulo, funcao in (("COUNT + página (antes)", separado), ("COUNT(*) OVER()", janela)):
+                t = timeit.timeit(funcao, number=repeticoes)
+                print(f"  {rotulo:<28} {t / repeticoes * 1e3:10.2f} ms/request")
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cenario", choices=["serializacao", "kpis", "brl", "senhas", "listagem"])
+    parser.add_argument("--repeticoes", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.cenario == "serializacao":
+        bench_serializacao(args.repeticoes)
+    elif args.cenario == "kpis":
+        bench_kpis(args.repeticoes)
+    elif args.cenario == "brl":
+        bench_brl(args.repeticoes)
+    elif args.cenario == "senhas":
+        bench_senhas(args.repeticoes)
+    elif args.cenario == "listagem":
+        bench_listagem(args.repeticoes)
@@ -19,6 +19,10 @@ CREATE TABLE IF NOT EXISTS recharges (
     odometro REAL NOT NULL,
     local TEXT,
     observacoes TEXT,
+    -- Mês da recarga como inteiro (ano * 12 + mês - 1), o mesmo valor do schema_postgres.sql, calculado
+    -- pelo banco na leitura. VIRTUAL porque o SQLite só aceita esse tipo no ALTER TABLE
+    -- (app_sqlite3.py adiciona em bancos antigos).
+    mes INTEGER GENERATED ALWAYS AS (CAST(strftime('%Y', data) AS INTEGER) * 12 + CAST(strftime('%m', data) AS INTEGER) - 1) VIRTUAL,
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
@@ -5,9 +5,13 @@ CREATE TABLE IF NOT EXISTS users (
     id SERIAL PRIMARY KEY, -- Alterado de INTEGER PRIMARY KEY AUTOINCREMENT
     nome VARCHAR(100) NOT NULL, -- Alterado de TEXT
     email VARCHAR(255) NOT NULL UNIQUE, -- Alterado de TEXT
-    senha_hash VARCHAR(255) NOT NULL -- Alterado de TEXT
+    senha_hash VARCHAR(255) NOT NULL, -- Alterado de TEXT
+    regiao VARCHAR(50) -- opcional: agrupa o ranking entre usuários (/api/ranking)
 );
 
+-- Bancos criados antes da coluna regiao
+ALTER TABLE users ADD COLUMN IF NOT EXISTS regiao VARCHAR(50);
+
 -- Criar tabela de recargas
 CREATE TABLE IF NOT EXISTS recharges (
     id SERIAL PRIMARY KEY, -- Alterado de INTEGER PRIMARY KEY AUTOINCREMENT
@@ -19,12 +23,77 @@ CREATE TABLE IF NOT EXISTS recharges (
     odometro REAL NOT NULL,
     local VARCHAR(255), -- Alterado de TEXT
     observacoes TEXT,
+    -- Mês da recarga como inteiro (ano * 12 + mês - 1), calculado pelo banco: agrupamentos mensais sem parse no Python
+    mes INTEGER GENERATED ALWAYS AS (EXTRACT(YEAR FROM data)::int * 12 + EXTRACT(MONTH FROM data)::int - 1) STORED,
+    -- Km rodados desde a recarga anterior do usuário (ordem: dia, id) e o id dela; NULL na primeira.
+    -- Mantidos pelo app a cada escrita (atualizar_km_delta): km de qualquer período = SUM(km_delta)
+    km_delta REAL,
+    prev_id INTEGER,
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
+-- Bancos criados antes da coluna mes
+ALTER TABLE recharges ADD COLUMN IF NOT EXISTS
+    mes INTEGER GENERATED ALWAYS AS (EXTRACT(YEAR FROM data)::int * 12 + EXTRACT(MONTH FROM data)::int - 1) STORED;
+
+-- Bancos criados antes de km_delta/prev_id: cria as colunas e preenche (só grava linhas divergentes)
+ALTER TABLE recharges ADD COLUMN IF NOT EXISTS km_delta REAL;
+ALTER TABLE recharges ADD COLUMN IF NOT EXISTS prev_id INTEGER;
+UPDATE recharges r SET km_delta = j.km_delta, prev_id = j.prev_id
+FROM (
+    SELECT id, odometro - LAG(odometro) OVER w AS km_delta, LAG(id) OVER w AS prev_id
+    FROM recharges
+    WINDOW w AS (PARTITION BY user_id ORDER BY CAST(data AS date), id)
+) j
+WHERE r.id = j.id AND (r.km_delta IS DISTINCT FROM j.km_delta OR r.prev_id IS DISTINCT FROM j.prev_id);
+
 -- Criar índice para otimizar consultas por usuário e data
 CREATE INDEX IF NOT EXISTS idx_recharges_user_date ON recharges(user_id, data);
 
+-- Nenhuma consulta filtra ou ordena por mes: os KPIs leem as recargas do usuário pela ordem de
+-- idx_recharges_user_date e agrupam por mes em memória; períodos usam recharges_rollups.
+-- O índice criado em versões anteriores só custava escrita.
+DROP INDEX IF EXISTS idx_recharges_user_mes;
+
+-- Totais por dia ('d') e por mês ('m') de cada usuário, mantidos pelo app a cada escrita
+-- (recargas_alteradas): comparações de períodos somam poucas linhas daqui, sem ler recharges
+CREATE TABLE IF NOT EXISTS recharges_rollups (
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    granularidade CHAR(1) NOT NULL, -- 'd' | 'm'
+    inicio DATE NOT NULL, -- o dia, ou o primeiro dia do mês
+    recargas INTEGER NOT NULL,
+    isentas INTEGER NOT NULL,
+    km DOUBLE PRECISION NOT NULL, -- soma de km_delta
+    kwh DOUBLE PRECISION NOT NULL,
+    custo_total DOUBLE PRECISION NOT NULL,
+    custo_pagas DOUBLE PRECISION NOT NULL,
+    sketch JSONB, -- percentis do dia ('d'); ver recharges_sketches
+    PRIMARY KEY (user_id, granularidade, inicio)
+);
+
+-- Sketch de percentis de cada dia (só nas linhas 'd'); bancos criados antes da coluna
+ALTER TABLE recharges_rollups ADD COLUMN IF NOT EXISTS sketch JSONB;
+
+-- Sketch de percentis de cada usuário: soma dos sketches dos dias, mantida pelo app
+CREATE TABLE IF NOT EXISTS recharges_sketches (
+    user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    sketch JSONB NOT NULL
+);
+
+-- Rollups e sketches de bancos existentes (ou de dados gravados fora do app):
+--   flask --app app rebuild-rollups
+
+-- Ranking entre usuários: cortes p0..p100 de cada métrica, para todos (regiao = '') e por região.
+-- Reconstruída pelo job agendado "flask --app app ranking-build"
+CREATE TABLE IF NOT EXISTS ranking_percentis (
+    regiao VARCHAR(50) NOT NULL,
+    metrica VARCHAR(30) NOT NULL, -- custo_kwh | consumo_100km
+    usuarios INTEGER NOT NULL,
+    percentis DOUBLE PRECISION[] NOT NULL,
+    calculado_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (regiao, metrica)
+);
+
 -- Criar tabela de configurações
 CREATE TABLE IF NOT EXISTS settings (
     id SERIAL PRIMARY KEY, -- Alterado de INTEGER PRIMARY KEY AUTOINCREMENT
@@ -51,3 +120,23 @@ CREATE TABLE IF NOT EXISTS contact_logs (
 
 -- Criar índice para otimizar consultas por data de envio
 CREATE INDEX IF NOT EXISTS idx_contact_logs_date ON contact_logs(data_envio);
+
+-- Fila de e-mails (outbox): gravada pelas rotas, enviada pelo worker "flask --app app mail-worker"
+CREATE TABLE IF NOT EXISTS mail_outbox (
+    id SERIAL PRIMARY KEY,
+    contact_log_id INTEGER REFERENCES contact_logs(id) ON DELETE SET NULL,
+    assunto VARCHAR(255) NOT NULL,
+    remetente VARCHAR(255),
+    destinatarios TEXT NOT NULL, -- separados por vírgula
+    reply_to VARCHAR(255),
+    corpo TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pendente', -- pendente | enviado | falhou
+    tentativas INTEGER NOT NULL DEFAULT 0,
+    proxima_tentativa TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    ultimo_erro TEXT,
+    criado_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    enviado_em TIMESTAMP
+);
+
+-- Índice parcial: o worker só procura itens pendentes
+CREATE INDEX IF NOT EXISTS idx_mail_outbox_pendentes ON mail_outbox(proxima_tentativa) WHERE status = 'pendente';
@@ -1,9 +1,12 @@
 
+// URL da API vem do atributo data-monthly-url da própria tag <script>
+const MonthlyDataUrl = document.currentScript.dataset.monthlyUrl;
+
 (async function () {
   // Busca dados agregados por mês
   let apiData;
   try {
-    const res = await fetch("{{ url_for('api_recharges_monthly') }}");
+    const res = await fetch(MonthlyDataUrl);
     apiData = await res.json();
   } catch (err) {
     console.error(LoadMonthlyDataErrorMessage, err);
@@ -58,13 +58,14 @@ async function loadRecharges() {
         tbody.innerHTML = '';
 
         if (data.items.length === 0) {
-            tbody.innerHTML = `<tr><td colspan="8" class="text-center">${NoRechargesFound}</td></tr>`;
+            tbody.innerHTML = `<tr><td colspan="9" class="text-center">${NoRechargesFound}</td></tr>`;
             
         } else {
             data.items.forEach(item => {
                 const tr = document.createElement('tr');
                 tr.dataset.id = item.id;
                 tr.innerHTML = `
+                    <td><input type="checkbox" class="form-check-input row-select"></td>
                     <td>${formatDateYMD(item.data)}</td>
                     <td>${item.kwh}</td>
                     <td>${CurrencySymbolBRL} ${item.custo.toFixed(2)}</td>
@@ -81,6 +82,7 @@ async function loadRecharges() {
             });
         }
 
+        updateBulkButtons();
         document.getElementById('pagination-info').textContent = `${DisplayingText} ${(currentPage - 1) * pageSize + 1}–${Math.min(currentPage * pageSize, data.total)} ${OfText} ${data.total}`;
         document.getElementById('btn-prev-page').disabled = !data.has_prev;
         document.getElementById('btn-next-page').disabled = !data.has_next;
@@ -144,13 +146,13 @@ document.getElementById('recharges-body').addEventListener('click', (e) => {
         const tr = e.target.closest('tr');
         const id = tr.dataset.id;
         document.getElementById('edit-id').value = id;
-        document.getElementById('edit-data').value = formatDateYMD(tr.children[0].textContent);
-        document.getElementById('edit-kwh').value = tr.children[1].textContent;
-        document.getElementById('edit-custo').value = tr.children[2].textContent.replace(/[^\d.,]/g, '').replace(',', '.');
-        document.getElementById('edit-isento').checked = tr.children[3].textContent === 'Sim';
-        document.getElementById('edit-odometro').value = tr.children[4].textContent;
-        document.getElementById('edit-local').value = tr.children[5].textContent;
-        document.getElementById('edit-observacoes').value = tr.children[6].getAttribute('title');
+        document.getElementById('edit-data').value = formatDateYMD(tr.children[1].textContent);
+        document.getElementById('edit-kwh').value = tr.children[2].textContent;
+        document.getElementById('edit-custo').value = tr.children[3].textContent.replace(/[^\d.,]/g, '').replace(',', '.');
+        document.getElementById('edit-isento').checked = tr.children[4].textContent === 'Sim';
+        document.getElementById('edit-odometro').value = tr.children[5].textContent;
+        document.getElementById('edit-local').value = tr.children[6].textContent;
+        document.getElementById('edit-observacoes').value = tr.children[7].getAttribute('title');
         const editModal = new bootstrap.Modal(document.getElementById('editModal'));
         editModal.show();
     }
@@ -224,6 +226,64 @@ document.getElementById('btn-confirm-delete').addEventListener('click', async ()
     }
 });
 
+// ==================== Ações em Lote ====================
+function selectedIds() {
+    return Array.from(document.querySelectorAll('#recharges-body .row-select:checked'))
+        .map(cb => parseInt(cb.closest('tr').dataset.id, 10));
+}
+
+function updateBulkButtons() {
+    const count = selectedIds().length;
+    document.getElementById('btn-bulk-delete').disabled = count === 0;
+    document.getElementById('btn-bulk-isento').disabled = count === 0;
+    document.getElementById('select-all').checked =
+        count > 0 && count === document.querySelectorAll('#recharges-body .row-select').length;
+}
+
+async function runBulkAction(payload) {
+    try {
+        const response = await fetch('/api/manage_recharges/bulk', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': document.querySelector('meta[name="csrf-token"]').getAttribute('content')
+            },
+            body: JSON.stringify(payload)
+        });
+
+        if (!response.ok) throw new Error(ErrorBulkMessage);
+
+        const data = await response.json();
+        showToast(`${BulkDoneMessage} ${data.affected}`, 'success');
+        loadRecharges();
+    } catch (error) {
+        showToast(error.message, 'danger');
+    }
+}
+
+document.getElementById('recharges-body').addEventListener('change', (e) => {
+    if (e.target.classList.contains('row-select')) updateBulkButtons();
+});
+
+document.getElementById('select-all').addEventListener('change', (e) => {
+    document.querySelectorAll('#recharges-body .row-select').forEach(cb => { cb.checked = e.target.checked; });
+    updateBulkButtons();
+});
+
+document.getElementById('btn-bulk-isento').addEventListener('click', () => {
+    runBulkAction({ action: 'set_isento', isento: true, ids: selectedIds() });
+});
+
+document.getElementById('btn-bulk-delete').addEventListener('click', () => {
+    const bulkDeleteModal = new bootstrap.Modal(document.getElementById('bulkDeleteModal'));
+    bulkDeleteModal.show();
+});
+
+document.getElementById('btn-confirm-bulk-delete').addEventListener('click', async () => {
+    bootstrap.Modal.getInstance(document.getElementById('bulkDeleteModal')).hide();
+    await runBulkAction({ action: 'delete', ids: selectedIds() });
+});
+
 
 // ==================== Botão Exportar CSV ====================    
 /*